@@ -0,0 +1,252 @@
+"""Local vector index over chat messages and personal memories
+
+Texts are embedded with the hashing trick - word and character-trigram features
+hashed into EMBEDDING_DIM signed buckets and L2-normalised - so there's no model to
+download and embedding a message costs microseconds. Similar wording lands close
+together (dose/dosing share trigrams), which is what reply grounding needs.
+
+Vectors live in a memory-mapped float32 file next to the database, with a second
+memmap holding each row's kind, source row id, chat, thread, user and timestamp.
+SQLite stays the source of truth: sync() indexes rows added since the highest id
+already indexed, and searches look the texts up by id, so rows deleted by
+retention simply stop coming back. Search is a brute-force dot product over the
+rows of one chat. Pruned rows are only flagged, so once they're most of the index
+it's rewritten without them.
+"""
+import logging
+import os
+import re
+import threading
+import zlib
+
+np = None  # numpy, imported by available() - it's slow to import and only needed once the index opens
+META_DTYPE = None
+_numpy_missing = False
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 256
+EMBEDDING_INDEX_PATH = os.getenv("EMBEDDING_INDEX_PATH")  # Defaults to <MEMORY_DB>-vec
+SYNC_BATCH_SIZE = 2000  # Rows embedded per sync() call
+INITIAL_CAPACITY = 4096
+COMPACT_DELETED_SHARE = 0.5  # prune() rewrites the index once this share of its rows is deleted
+
+KIND_MESSAGE = 1
+KIND_MEMORY = 2
+DELETED = 0x80  # Flag set on a row's kind once it's pruned (keeps last_ref right)
+
+_WORD = re.compile(r"\w+(?:[.,]\w+)*")
+STOPWORDS = frozenset("""a an and are as at be but by for from has have i i'm im in is it its just me my of on or
+so that the this to was we were what when with you your u lol""".split())
+
+
+def available():
+    """True if numpy is installed, importing it on the first call (before anything else here is used)"""
+    global np, META_DTYPE, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            _numpy_missing = True
+            return False
+        META_DTYPE = numpy.dtype([("kind", "u1"), ("ref", "i8"), ("chat", "i8"), ("thread", "i8"),
+                                  ("user", "i8"), ("ts", "i8")])
+        np = numpy
+    return np is not None
+
+
+def embed(text):
+    """Unit-length hashed feature vector for text (all zeros if it has no usable words)"""
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for word in _WORD.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        features = [(word, 1.0)]
+        if len(word) > 3:
+            padded = f"#{word}#"
+            features += [(padded[i:i + 3], 0.3) for i in range(len(padded) - 2)]
+        for feature, weight in features:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vector[h % EMBEDDING_DIM] += weight if h & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class VectorIndex:
+    """Append-only memmapped vectors plus metadata, grown by doubling and compacted after prunes"""
+
+    def __init__(self, path, dim=EMBEDDING_DIM):
+        self.path = path
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._scanned = {}  # kind -> highest source row id sync() has read, indexed or skipped
+        self._open()
+
+    def _open(self, capacity=None):
+        vec_path, meta_path = f"{self.path}", f"{self.path}meta"
+        if capacity is None and os.path.exists(meta_path) and os.path.getsize(meta_path):
+            capacity = os.path.getsize(meta_path) // META_DTYPE.itemsize
+            if not os.path.exists(vec_path) or os.path.getsize(vec_path) != capacity * self.dim * 4:
+                logger.warning("Vector index files don't match, rebuilding the index")
+                for path in (vec_path, meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                capacity = None
+        mode = "r+" if capacity is not None and os.path.exists(meta_path) else "w+"
+        capacity = capacity or INITIAL_CAPACITY
+        self.vectors = np.memmap(vec_path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+        self.meta = np.memmap(meta_path, dtype=META_DTYPE, mode=mode, shape=(capacity,))
+        # Rows are filled in order, so the first empty one is the count
+        empty = np.flatnonzero(self.meta["kind"] == 0)
+        self.count = int(empty[0]) if len(empty) else capacity
+
+    def _grow(self):
+        old_vectors, old_meta, count = self.vectors, self.meta, self.count
+        capacity = len(old_meta) * 2
+        old_vectors.flush()
+        old_meta.flush()
+        del self.vectors, self.meta
+        for suffix, itemsize in (("", self.dim * 4), ("meta", META_DTYPE.itemsize)):
+            with open(f"{self.path}{suffix}", "r+b") as f:
+                f.truncate(capacity * itemsize)
+        self._open(capacity)
+        self.count = count
+
+    def last_ref(self, kind):
+        """Highest source row id indexed for this kind (0 if none)"""
+        with self._lock:
+            kinds = self.meta["kind"][:self.count] & (DELETED - 1)
+            refs = self.meta["ref"][:self.count][kinds == kind]
+            return int(refs.max()) if len(refs) else 0
+
+    def scanned_ref(self, kind):
+        """Highest source row id already read for this kind, so sync() carries on after it"""
+        return max(self._scanned.get(kind, 0), self.last_ref(kind))
+
+    def mark_scanned(self, kind, ref):
+        self._scanned[kind] = max(self._scanned.get(kind, 0), ref)
+
+    def add(self, kind, rows):
+        """Index (ref_id, chat_id, thread_id, user_id, timestamp, text) rows"""
+        with self._lock:
+            for ref, chat, thread, user, ts, text in rows:
+                if self.count == len(self.meta):
+                    self._grow()
+                self.vectors[self.count] = embed(text or "")
+                self.meta[self.count] = (kind, ref, chat, thread, user, ts)
+                self.count += 1
+
+    def search(self, query, kind, k, chat_id=None, thread_id=None, user_id=None, min_score=0.0):
+        """Top k (score, ref_id) among rows matching the filters"""
+        q = embed(query)
+        if not q.any():
+            return []
+        with self._lock:
+            meta = self.meta[:self.count]
+            mask = meta["kind"] == kind
+            if chat_id is not None:
+                mask &= meta["chat"] == chat_id
+            if thread_id is not None:
+                mask &= meta["thread"] == thread_id
+            if user_id is not None:
+                mask &= meta["user"] == user_id
+            rows = np.flatnonzero(mask)
+            if not len(rows):
+                return []
+            scores = self.vectors[rows] @ q
+            refs = meta["ref"][rows]
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(refs[i])) for i in top if scores[i] >= min_score]
+
+    def prune(self, kind, before_ts):
+        """Mark rows older than before_ts as deleted, returns how many"""
+        with self._lock:
+            meta = self.meta[:self.count]
+            old = np.flatnonzero((meta["kind"] == kind) & (meta["ts"] < before_ts))
+            self.meta["kind"][old] = kind | DELETED
+            deleted = np.count_nonzero(meta["kind"] & DELETED)
+            if deleted and deleted >= self.count * COMPACT_DELETED_SHARE:
+                self._compact()
+            return len(old)
+
+    def _compact(self):
+        """Rewrite the files with only the live rows (caller holds the lock)
+
+        The newest row of each kind is kept even when it's deleted, so last_ref - and
+        with it where sync() carries on - doesn't go back.
+        """
+        meta = self.meta[:self.count]
+        kinds = meta["kind"] & (DELETED - 1)
+        keep = (meta["kind"] & DELETED) == 0
+        for kind in np.unique(kinds):
+            rows = np.flatnonzero(kinds == kind)
+            keep[rows[np.argmax(meta["ref"][rows])]] = True
+        rows = np.flatnonzero(keep)
+        capacity = INITIAL_CAPACITY
+        while capacity <= len(rows):
+            capacity *= 2
+        # Written beside the old files and swapped in; a crash between the swaps leaves files
+        # that don't match, which _open rebuilds
+        for suffix, dtype, shape, data in (("", np.float32, (capacity, self.dim), self.vectors[rows]),
+                                           ("meta", META_DTYPE, (capacity,), meta[rows])):
+            fresh = np.memmap(f"{self.path}{suffix}.tmp", dtype=dtype, mode="w+", shape=shape)
+            fresh[:len(rows)] = data
+            fresh.flush()
+            del fresh
+        removed = self.count - len(rows)
+        del self.vectors, self.meta, meta
+        for suffix in ("", "meta"):
+            os.replace(f"{self.path}{suffix}.tmp", f"{self.path}{suffix}")
+        self._open()
+        logger.info(f"Compacted the vector index: {removed} deleted rows removed, {self.count} left")
+
+    def reset(self):
+        """Drop every row (the database it was built from is gone)"""
+        with self._lock:
+            del self.vectors, self.meta
+            os.remove(self.path)
+            os.remove(f"{self.path}meta")
+            self._scanned = {}
+            self._open()
+
+    def flush(self):
+        with self._lock:
+            self.vectors.flush()
+            self.meta.flush()
+
+
+def sync(index, conn, bot_user_id=0, batch_size=SYNC_BATCH_SIZE, owns_chat=None):
+    """Index messages and personal memories added since the last sync, returns rows read
+
+    Messages from chats owns_chat(chat_id) rejects are skipped (another worker indexes them).
+    """
+    # AUTOINCREMENT ids are never reused, so an index ahead of them belongs to another database
+    for kind, table in ((KIND_MESSAGE, "memory"), (KIND_MEMORY, "personal_memories")):
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+        if index.last_ref(kind) > (row[0] if row else 0):
+            logger.warning(f"Vector index is ahead of the {table} table, rebuilding it")
+            index.reset()
+            break
+
+    # Reading carries on from the last row read, not the last one indexed: rows of other
+    # workers' chats are skipped, and must not be read again on every call
+    indexed = 0
+    messages = conn.execute("""SELECT id, chat_id, thread_id, user_id, timestamp, message FROM memory
+                               WHERE id > ? AND user_id != ? ORDER BY id LIMIT ?""",
+                            (index.scanned_ref(KIND_MESSAGE), bot_user_id, batch_size)).fetchall()
+    index.add(KIND_MESSAGE, [row for row in messages if owns_chat is None or owns_chat(row[1])])
+    if messages:
+        index.mark_scanned(KIND_MESSAGE, messages[-1][0])
+    indexed += len(messages)
+
+    memories = conn.execute("""SELECT id, COALESCE(chat_id, 0), 0, user_id, timestamp, memory_content
+                               FROM personal_memories WHERE id > ? ORDER BY id LIMIT ?""",
+                            (index.scanned_ref(KIND_MEMORY), batch_size)).fetchall()
+    index.add(KIND_MEMORY, memories)
+    if memories:
+        index.mark_scanned(KIND_MEMORY, memories[-1][0])
+    indexed += len(memories)
+    if indexed:
+        index.flush()
+    return indexed
@@ -1,2 +1,5 @@
 #!/bin/bash
+# Fetch the tokenizer encoding into tiktoken_cache/ (or $TIKTOKEN_CACHE_DIR) before the bot starts,
+# so it's loaded from disk; if this fails the bot estimates token counts instead
+python3 -c "import prompts; prompts.load_encoding()"
 python3 main.py
@@ -1,11 +1,19 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # Before the other imports, so the startup timing includes them
+
 import os
+import re
 import logging
 import sqlite3
 import random
 import asyncio
 import signal
 import sys
-import time
+import threading
+import hashlib
+import importlib
+import json
+from bisect import bisect_left
 from datetime import datetime, timedelta, timezone
 from logging.handlers import RotatingFileHandler
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
@@ -17,10 +25,23 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler
 )
-from openai import OpenAI
-from collections import defaultdict
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from collections import defaultdict, OrderedDict
+
+import storage
+import sharding
+import scheduler
+import ratelimit
+import prompts
+import embeddings
+import retention
+
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))  # Seconds per completion request
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "4"))  # Parallel completions
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))  # Updates handled at the same time
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # "polling" or "webhook" (see webhook.py)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")  # Bot API base URL, e.g. a local fake server in tests
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 # Setup rotating file handler for logs
@@ -39,19 +60,272 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-chat_history = defaultdict(list)
 cooldowns = {}
-processed_messages = set()
-MEMORY_DB = "memory.sqlite"
 DAILY_LIMIT = int(os.getenv("DAILY_LIMIT", "1500"))  # Make configurable
 IMAGE_COST_MULTIPLIER = 3  # Images cost more
 BOT_VERSION = "2.2"
 MAX_MESSAGE_LENGTH = 2000  # Prevent very long messages
 DATA_RETENTION_DAYS = 30  # Keep data for 30 days
+MEMORY_RETENTION_DAYS = 60  # Personal memories with a high emotional weight are kept longer
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))  # Queued messages per transaction
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "2"))  # Max seconds a message waits in the queue
+USAGE_CHECKPOINT_INTERVAL = float(os.getenv("USAGE_CHECKPOINT_INTERVAL", "30"))  # Seconds between usage saves
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "500"))  # In-memory messages per topic
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", str(256 * 1024)))  # In-memory text per topic
+HISTORY_MAX_AGE = 7200  # Seconds of history kept in memory per topic
+HISTORY_COVERAGE_MAX_AGE = 86400  # Seconds a deleted topic history's coverage is remembered per topic
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", "10000"))  # Message ids remembered for dedup
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "86400"))  # Seconds a message id is remembered
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "true").lower() == "true"  # Remember them across restarts
+MEMORY_CLEANUP_INTERVAL = 300  # Seconds between in-memory cleanups
+USER_CONTEXT_CACHE_SIZE = int(os.getenv("USER_CONTEXT_CACHE_SIZE", "1000"))  # Users whose context is kept in memory
+USER_CONTEXT_MEMORIES = 8  # Top memories kept per user (what the prompts use)
+SEARCH_RESULTS = 5  # Matches shown by /search
+EMBEDDING_SYNC_INTERVAL = 15  # Seconds between vector index catch-ups
+RETRIEVAL_TOP_K = 4  # Related older messages (and extra memories) added to a reply prompt
+RETRIEVAL_MIN_SCORE = 0.3  # Cosine similarity below which a match isn't worth the tokens
+RETRIEVAL_MAX_TOKENS = 400  # Most the related messages may take in a reply prompt
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # Seconds a cached reply stays valid (0 = off)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+TLDR_CHUNK_TOKENS = int(os.getenv("TLDR_CHUNK_TOKENS", "3000"))  # Conversation tokens per summary request
+TLDR_MAX_CHUNKS = int(os.getenv("TLDR_MAX_CHUNKS", "24"))  # Older chunks beyond this are skipped
+TLDR_MERGE_FANIN = 8  # Summaries merged per request in the reduce step
+TLDR_FANOUT = 4  # Chunk or merge requests one /tldr has waiting or running at once
+TLDR_CHUNK_CACHE_SIZE = 512  # Chunk summaries kept for overlapping /tldr windows
+TLDR_BULK_MINUTES = 360  # Windows longer than this are scheduled as bulk jobs
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))  # System prompt tokens for a reply
+CHAT_CONTEXT_MAX_TOKENS = 800  # Most the recent chat lines may take in a reply prompt
+CHAT_CONTEXT_MIN_MESSAGES = 4  # Recent lines always taken, however far apart (within CHAT_CONTEXT_MAX_AGE)
+CHAT_CONTEXT_MAX_MESSAGES = 40  # Most recent lines taken, however short
+CHAT_CONTEXT_MAX_AGE = 21600  # Seconds back the recent chat context may reach
+CHAT_CONTEXT_GAP = 1800  # A lull this long ends the conversation the context is taken from
+MEMORY_MAX_TOKENS = 600  # Most the personal memories may take in a reply prompt
+USER_PROMPT_MAX_TOKENS = 1000  # Longer messages to the bot are cut to this
+COMPLETION_TOKEN_ESTIMATE = 400  # Reply tokens assumed when pacing a request, corrected from its usage
+IMAGE_TOKEN_ESTIMATE = 800  # Prompt tokens assumed for an image
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() == "true"  # Show replies as they're generated
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "2"))  # Min seconds between edits of a streamed reply
+TELEGRAM_MAX_TEXT = 4096  # Longest text Telegram takes in one message
+ROLLING_SUMMARY_SLACK = 0.1  # A checkpoint is reused if its window start is within this share of the window
 
 # Global shutdown flag
 shutdown_flag = False
 
+# Long-running tasks started in on_startup, cancelled in on_shutdown
+background_tasks = []
+
+# Vector index over messages and memories, opened after startup if numpy is installed (see embeddings.py)
+vector_index = None
+
+# Created by get_openai_client on the first completion (or the warm-up after startup)
+openai_client = None
+
+# Every completion waits here for one of OPENAI_MAX_CONCURRENCY slots (see scheduler.py)
+ai_scheduler = scheduler.FairScheduler(OPENAI_MAX_CONCURRENCY, budget_left=lambda: DAILY_LIMIT - get_daily_usage(),
+                                       daily_limit=DAILY_LIMIT)
+# ...and then paces itself against OpenAI's request/token limits (see ratelimit.py)
+rate_limiter = ratelimit.RateLimiter()
+
+class HistoryEntry:
+    """One message in the in-memory history"""
+    __slots__ = ("timestamp", "user", "text", "size")
+    
+    def __init__(self, timestamp, user, text):
+        self.timestamp = timestamp  # Epoch seconds
+        self.user = user
+        self.text = text
+        self.size = len(text.encode("utf-8"))
+
+class ThreadHistory:
+    """Bounded ring buffer of HistoryEntry for one (chat, thread), oldest first
+    
+    Appending past max_messages or max_bytes drops the oldest entries, and entries
+    are appended in time order, so a time window's start is found by bisection.
+    """
+    __slots__ = ("_slots", "_head", "_count", "nbytes", "max_bytes", "dropped_until")
+    
+    def __init__(self, max_messages=HISTORY_MAX_MESSAGES, max_bytes=HISTORY_MAX_BYTES):
+        self._slots = [None] * max_messages
+        self._head = 0
+        self._count = 0
+        self.nbytes = 0
+        self.max_bytes = max_bytes
+        self.dropped_until = 0  # Timestamp of the newest entry dropped, anything after it is still here
+    
+    def __len__(self):
+        return self._count
+    
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self._slots[(self._head + index) % len(self._slots)]
+    
+    def append(self, entry):
+        if self._count == len(self._slots):
+            self.popleft()
+        self._slots[(self._head + self._count) % len(self._slots)] = entry
+        self._count += 1
+        self.nbytes += entry.size
+        while self.nbytes > self.max_bytes and self._count > 1:
+            self.popleft()
+    
+    def popleft(self):
+        entry = self._slots[self._head]
+        self._slots[self._head] = None
+        self._head = (self._head + 1) % len(self._slots)
+        self._count -= 1
+        self.nbytes -= entry.size
+        self.dropped_until = max(self.dropped_until, entry.timestamp)
+        return entry
+    
+    def expire(self, cutoff):
+        """Drop entries older than cutoff (epoch seconds) from the front"""
+        while self._count and self._slots[self._head].timestamp < cutoff:
+            self.popleft()
+    
+    def since(self, cutoff):
+        """Entries at or after cutoff (epoch seconds), oldest first"""
+        start = bisect_left(self, cutoff, key=lambda entry: entry.timestamp)
+        return [self[i] for i in range(start, self._count)]
+    
+    def clear(self):
+        if self._count:
+            self.dropped_until = max(self.dropped_until, self[self._count - 1].timestamp)
+        self._slots = [None] * len(self._slots)
+        self._head = 0
+        self._count = 0
+        self.nbytes = 0
+
+chat_history = defaultdict(ThreadHistory)
+history_started = time.time()  # In-memory history only has messages seen since this process started
+history_dropped = {}  # (chat, thread) -> dropped_until of histories deleted by forget_history
+history_pruned_until = 0  # Newest dropped_until pruned from history_dropped, applies to every topic
+
+def forget_history(key):
+    """Delete a topic's in-memory history, remembering up to when it no longer has every message"""
+    history = chat_history.pop(key)
+    history.clear()
+    history_dropped[key] = max(history_dropped.get(key, 0), history.dropped_until)
+
+def prune_history_dropped(horizon):
+    """Drop history_dropped entries older than horizon, folding them into history_pruned_until"""
+    global history_pruned_until
+    for key in [key for key, dropped in history_dropped.items() if dropped < horizon]:
+        history_pruned_until = max(history_pruned_until, history_dropped.pop(key))
+
+def history_covered_from(key):
+    """Time after which the in-memory history holds every message of the topic"""
+    history = chat_history.get(key)
+    dropped = history.dropped_until if history is not None else 0
+    return max(history_started, dropped, history_dropped.get(key, 0), history_pruned_until)
+
+class DedupCache:
+    """Recently seen keys with a TTL and a size cap
+    
+    Keys are kept in the order they were first seen, which with a fixed TTL is
+    also expiry order, so expired and overflow entries are dropped from the front.
+    """
+    
+    def __init__(self, max_size=DEDUP_MAX_SIZE, ttl=DEDUP_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen = OrderedDict()  # key -> first seen (epoch seconds)
+    
+    def __len__(self):
+        return len(self._seen)
+    
+    def __contains__(self, key):
+        seen_at = self._seen.get(key)
+        return seen_at is not None and seen_at > time.time() - self.ttl
+    
+    def add(self, key, seen_at=None):
+        if key not in self._seen:
+            self._seen[key] = seen_at or time.time()
+            if len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+    
+    def check_and_add(self, key):
+        """True if key was already seen, otherwise remember it and return False"""
+        self.expire()
+        if key in self._seen:
+            return True
+        self.add(key)
+        return False
+    
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at > cutoff:
+                break
+            self._seen.popitem(last=False)
+
+processed_messages = DedupCache()
+
+class UserContextCache:
+    """LRU of per-user context snapshots (nickname, interaction count, top memories)
+    
+    Filled from the database on a miss and then kept current by the write paths
+    (note_message, note_memory) instead of being re-read, so a warm mention needs
+    no queries. Shared by the event loop and storage threads, hence the lock.
+    """
+    
+    def __init__(self, max_size=USER_CONTEXT_CACHE_SIZE, max_memories=USER_CONTEXT_MEMORIES):
+        self.max_size = max_size
+        self.max_memories = max_memories
+        self._entries = OrderedDict()  # user_id -> context dict
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, user_id):
+        """A copy of the user's snapshot, or None if it isn't cached"""
+        with self._lock:
+            context = self._entries.get(user_id)
+            if context is None:
+                return None
+            self._entries.move_to_end(user_id)
+            return dict(context, memories=list(context["memories"]))
+    
+    def put(self, user_id, context):
+        with self._lock:
+            self._entries[user_id] = dict(context, memories=list(context["memories"][:self.max_memories]))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def note_message(self, user_id, user_name):
+        """Count a stored message toward a cached user's interactions"""
+        with self._lock:
+            context = self._entries.get(user_id)
+            if context is not None:
+                context["interaction_count"] += 1
+                context["nickname"] = user_name
+    
+    def note_memory(self, user_id, memory):
+        """Slot a new memory into a cached user's top memories (same order as get_personal_memories)"""
+        with self._lock:
+            context = self._entries.get(user_id)
+            if context is None:
+                return
+            key = (memory["type"], storage.content_hash(memory["content"]))
+            if any((m["type"], storage.content_hash(m["content"])) == key for m in context["memories"]):
+                return  # The database ignores duplicates too
+            memories = context["memories"] + [memory]
+            memories.sort(key=lambda m: (m["weight"], m["timestamp"]), reverse=True)
+            context["memories"] = memories[:self.max_memories]
+    
+    def invalidate(self, user_id=None):
+        """Drop one user's snapshot, or all of them"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+user_contexts = UserContextCache()
+
 PERSONALITIES = [
     "flirty and chaotic", "tired but observant", "glamorous and extra", 
     "shady but loving", "deeply emotional", "unbothered and wise",
@@ -60,13 +334,12 @@ PERSONALITIES = [
 
 def cleanup_memory():
     """Clean up memory structures periodically"""
-    global chat_history, cooldowns, processed_messages
+    global chat_history, cooldowns
     
     now = datetime.now(timezone.utc)
     
-    # Clean old processed messages (keep last 50)
-    if len(processed_messages) > 50:
-        processed_messages.clear()
+    # Drop expired message ids
+    processed_messages.expire()
     
     # Clean old cooldowns (remove entries older than 1 hour)
     old_cooldowns = [k for k, v in cooldowns.items() 
@@ -74,86 +347,69 @@ def cleanup_memory():
     for k in old_cooldowns:
         del cooldowns[k]
     
-    # Clean old chat history (keep last 2 hours per chat)
+    # Clean old chat history (keep last 2 hours per chat) - only expired entries are touched
+    cutoff = time.time() - HISTORY_MAX_AGE
     for key in list(chat_history.keys()):
-        chat_history[key] = [
-            msg for msg in chat_history[key]
-            if (now - msg["timestamp"]).total_seconds() <= 7200
-        ]
+        chat_history[key].expire(cutoff)
         # Remove empty chat histories
         if not chat_history[key]:
-            del chat_history[key]
+            forget_history(key)
+    prune_history_dropped(time.time() - HISTORY_COVERAGE_MAX_AGE)
 
-def cleanup_old_data():
-    """Clean up old data from database (monthly cleanup)"""
-    try:
-        conn = sqlite3.connect(MEMORY_DB)
-        cursor = conn.cursor()
-        
-        cutoff_date = (datetime.now(timezone.utc) - timedelta(days=DATA_RETENTION_DAYS)).isoformat()
-        
-        # Count what we're about to delete
-        cursor.execute("SELECT COUNT(*) FROM memory WHERE timestamp < ?", (cutoff_date,))
-        old_messages = cursor.fetchone()[0]
-        
-        # Delete old messages
-        cursor.execute("DELETE FROM memory WHERE timestamp < ?", (cutoff_date,))
-        
-        # Clean up old personal memories (keep important ones longer)
-        # Keep high emotional weight memories for 60 days, others for 30 days
-        memory_cutoff = (datetime.now(timezone.utc) - timedelta(days=60)).isoformat()
-        cursor.execute("DELETE FROM personal_memories WHERE timestamp < ? AND emotional_weight < 4", (cutoff_date,))
-        cursor.execute("DELETE FROM personal_memories WHERE timestamp < ?", (memory_cutoff,))
-        
-        # Clean up old daily usage data (keep only last 7 days)
-        seven_days_ago = (datetime.now(timezone.utc) - timedelta(days=7)).date().isoformat()
-        cursor.execute("DELETE FROM settings WHERE key LIKE 'daily_usage_%' AND key < ?", 
-                       (f"daily_usage_{seven_days_ago}",))
-        
-        # Clean up old user preferences for users who haven't interacted recently
-        cursor.execute("DELETE FROM user_preferences WHERE last_interaction < ?", (cutoff_date,))
-        
-        conn.commit()
-        conn.close()
-        
-        if old_messages > 0:
-            logger.info(f"Cleaned up {old_messages} old messages and associated data")
-        
-    except Exception as e:
-        logger.error(f"Error during data cleanup: {e}")
-
-def should_run_cleanup():
-    """Check if we should run the monthly cleanup"""
-    try:
-        conn = sqlite3.connect(MEMORY_DB)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'last_cleanup'")
-        row = cursor.fetchone()
-        conn.close()
-        
-        if not row:
-            return True
-        
-        last_cleanup = datetime.fromisoformat(row[0])
-        days_since_cleanup = (datetime.now(timezone.utc) - last_cleanup).days
-        
-        return days_since_cleanup >= 30
-        
-    except Exception as e:
-        logger.error(f"Error checking cleanup schedule: {e}")
-        return False
+async def memory_cleanup_loop():
+    """Periodically trim the in-memory structures"""
+    while True:
+        await asyncio.sleep(MEMORY_CLEANUP_INTERVAL)
+        try:
+            cleanup_memory()
+        except Exception as e:
+            logger.error(f"Memory cleanup failed: {e}")
+
+def _days_ago_ms(days):
+    return storage.now_ms() - days * 86400 * 1000
+
+# What the retention pass deletes (see retention.py); each cutoff is taken when the pass starts
+RETENTION_RULES = [
+    retention.Rule("messages", "memory", "timestamp < ?", lambda: _days_ago_ms(DATA_RETENTION_DAYS)),
+    # Keep high emotional weight memories for 60 days, others for 30 days
+    retention.Rule("memories", "personal_memories", "timestamp < ? AND emotional_weight < 4",
+                   lambda: _days_ago_ms(DATA_RETENTION_DAYS)),
+    retention.Rule("memories", "personal_memories", "timestamp < ?", lambda: _days_ago_ms(MEMORY_RETENTION_DAYS)),
+    # Usage only matters for today, a week is kept for looking back
+    retention.Rule("daily_usage", "daily_usage", "day < ?",
+                   lambda: (datetime.now(timezone.utc) - timedelta(days=7)).date().isoformat()),
+    # Message ids only matter for dedup while they're within the TTL
+    retention.Rule("processed_updates", "processed_updates", "seen_at < ?",
+                   lambda: storage.now_ms() - DEDUP_TTL * 1000, key="chat_id, message_id"),
+    # Expired cached replies would never be served again
+    retention.Rule("response_cache", "response_cache", "created_at < ?",
+                   lambda: storage.now_ms() - RESPONSE_CACHE_TTL * 1000, key="key"),
+    # Users who haven't interacted recently
+    retention.Rule("user_preferences", "user_preferences", "last_interaction < ?",
+                   lambda: _days_ago_ms(DATA_RETENTION_DAYS)),
+]
 
-def mark_cleanup_done():
-    """Mark that cleanup was completed"""
-    try:
-        conn = sqlite3.connect(MEMORY_DB)
-        cursor = conn.cursor()
-        cursor.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", 
-                       ('last_cleanup', datetime.now(timezone.utc).isoformat()))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error marking cleanup complete: {e}")
+async def run_retention():
+    """Delete expired data (once per deployment) and drop it from this process's caches"""
+    if sharding.is_primary():
+        report = await retention.run_pass(RETENTION_RULES)
+        logger.info(f"Retention pass: {retention.format_report(report)}")
+        await storage.run(storage.settings.set, "last_retention", json.dumps(report))
+        if report["rows"].get("memories") or report["rows"].get("user_preferences"):
+            user_contexts.invalidate()
+    if vector_index is not None:
+        await storage.run(vector_index.prune, embeddings.KIND_MESSAGE, _days_ago_ms(DATA_RETENTION_DAYS))
+        await storage.run(vector_index.prune, embeddings.KIND_MEMORY, _days_ago_ms(MEMORY_RETENTION_DAYS))
+
+async def retention_loop():
+    """Run a retention pass shortly after startup, then every RETENTION_INTERVAL"""
+    await asyncio.sleep(retention.RETENTION_START_DELAY)
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            logger.error(f"Retention pass failed: {e}")
+        await asyncio.sleep(retention.RETENTION_INTERVAL)
 
 def safe_db_operation(operation):
     """Wrapper for safe database operations with error handling and retries"""
@@ -162,6 +418,8 @@ def safe_db_operation(operation):
         try:
             return operation()
         except sqlite3.OperationalError as e:
+            # Connections are long-lived, so never leave a half-done transaction behind
+            storage.rollback()
             if "database is locked" in str(e) and attempt < max_retries - 1:
                 logger.warning(f"Database locked, retrying in {0.5 * (attempt + 1)}s...")
                 time.sleep(0.5 * (attempt + 1))
@@ -169,6 +427,7 @@ def safe_db_operation(operation):
             logger.error(f"Database operation failed after {attempt + 1} attempts: {e}")
             return None
         except Exception as e:
+            storage.rollback()
             logger.error(f"Database operation failed: {e}")
             return None
     return None
@@ -180,98 +439,314 @@ async def send_typing_action(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except:
         pass  # Don't fail if we can't send typing indicator
 
-async def safe_openai_call(messages, model="gpt-4o", max_retries=2):
-    """Make OpenAI API call with retry logic and error handling"""
-    for attempt in range(max_retries + 1):
+def get_openai_client():
+    """The AsyncOpenAI client, created on first use - importing openai is the slowest part of startup"""
+    global openai_client
+    if openai_client is None:
+        from openai import AsyncOpenAI
+        # Retries are handled in completion_with_retries, so the SDK's own retry loop is disabled
+        openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=OPENAI_TIMEOUT, max_retries=0)
+    return openai_client
+
+def is_rate_limit_error(error):
+    """True for openai.RateLimitError (by the time one is raised openai has been imported)"""
+    from openai import RateLimitError
+    return isinstance(error, RateLimitError)
+
+def note_rate_limit(error):
+    """Pause calls after a 429 that will pass - not insufficient_quota, a billing problem waiting won't fix"""
+    if is_rate_limit_error(error) and "insufficient_quota" not in str(error).lower():
+        rate_limiter.rate_limited(error.response.headers)
+
+def estimate_request_tokens(messages):
+    """Tokens a request will use against the rate limit - prompt plus a typical reply"""
+    total = COMPLETION_TOKEN_ESTIMATE
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content:
+            total += estimate_tokens(part["text"]) if part["type"] == "text" else IMAGE_TOKEN_ESTIMATE
+    return total
+
+async def create_completion(messages, model="gpt-4o", timeout=None, cost=1):
+    """Run one chat completion on the async client once the scheduler and rate limiter let it through"""
+    tokens = estimate_request_tokens(messages)
+    async with ai_scheduler.slot(cost):
+        await rate_limiter.acquire(tokens)
         try:
-            completion = client.chat.completions.create(
-                model=model,
-                messages=messages
+            # wait_for cancels the request if it runs over, and so does cancelling the handler
+            response = await asyncio.wait_for(
+                get_openai_client().chat.completions.with_raw_response.create(model=model, messages=messages),
+                timeout=timeout or OPENAI_TIMEOUT
             )
-            return completion.choices[0].message.content.strip()
+        except Exception as e:
+            note_rate_limit(e)
+            raise
+        completion = response.parse()
+        rate_limiter.settle(tokens, completion.usage.total_tokens if completion.usage else None)
+        rate_limiter.update_from_headers(response.headers)
+    return completion.choices[0].message.content.strip()
+
+def response_cache_key(model, messages):
+    """Fingerprint of a request - the model plus every message, system prompt included"""
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_response(key):
+    """Get a cached completion if there's one younger than RESPONSE_CACHE_TTL"""
+    def db_operation():
+        conn = storage.get_connection()
+        now = storage.now_ms()
+        row = conn.execute("SELECT response FROM response_cache WHERE key = ? AND created_at > ?",
+                           (key, now - RESPONSE_CACHE_TTL * 1000)).fetchone()
+        if row:
+            conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+            conn.commit()
+        return row[0] if row else None
+    
+    return safe_db_operation(db_operation)
+
+response_cache_writes = 0
+
+def store_cached_response(key, model, response):
+    """Cache a completion, evicting expired and least recently used entries now and then"""
+    global response_cache_writes
+    response_cache_writes += 1
+    evict = response_cache_writes % 50 == 0
+    
+    def db_operation():
+        conn = storage.get_connection()
+        now = storage.now_ms()
+        conn.execute("REPLACE INTO response_cache (key, model, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                     (key, model, response, now, now))
+        if evict:
+            conn.execute("DELETE FROM response_cache WHERE created_at <= ?", (now - RESPONSE_CACHE_TTL * 1000,))
+            conn.execute("""DELETE FROM response_cache WHERE key IN (
+                                SELECT key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+                         (RESPONSE_CACHE_MAX_ENTRIES,))
+        conn.commit()
+        return True
+    
+    return safe_db_operation(db_operation)
+
+async def completion_with_retries(messages, model="gpt-4o", max_retries=2, timeout=None, use_cache=True, cost=1):
+    """Chat completion that retries timeouts, rate limits and glitches, raising the last error
+    
+    Answers come from the response cache when an identical request was made within
+    RESPONSE_CACHE_TTL (pass use_cache=False to always ask the model). Only requests
+    that actually reach OpenAI count toward daily usage, with the given cost.
+    """
+    cache_key = response_cache_key(model, messages) if use_cache and RESPONSE_CACHE_TTL > 0 else None
+    if cache_key:
+        cached = await storage.run(get_cached_response, cache_key)
+        if cached is not None:
+            logger.info("Response cache hit")
+            return cached
+    
+    for attempt in range(max_retries + 1):
+        try:
+            reply = await create_completion(messages, model=model, timeout=timeout, cost=cost)
+            break
+        except scheduler.Rejected:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning(f"OpenAI call timed out (attempt {attempt + 1})")
+            if attempt < max_retries:
+                continue
+            raise
         except Exception as e:
             error_str = str(e).lower()
             
-            if "rate_limit" in error_str:
-                if attempt < max_retries:
-                    wait_time = (2 ** attempt) + random.uniform(0, 1)  # Exponential backoff
-                    logger.warning(f"Rate limited, waiting {wait_time:.1f}s (attempt {attempt + 1})")
-                    await asyncio.sleep(wait_time)
-                    continue
-                return "OpenAI is being slow right now, try again in a few minutes babe 🐌"
-            elif "context_length" in error_str:
-                return "That message was too long for my brain, try breaking it up? 🤯"
-            elif "content_policy" in error_str:
-                return "I can't respond to that bestie, let's keep it chill 😅"
+            # Retrying won't change these
+            if "context_length" in error_str or "content_policy" in error_str or "insufficient_quota" in error_str:
+                raise
+            if attempt >= max_retries:
+                raise
+            
+            if is_rate_limit_error(e):
+                # The rate limiter has paused calls for as long as OpenAI asked
+                logger.warning(f"Rate limited, retrying when the limiter allows (attempt {attempt + 1})")
+                continue
             else:
+                wait_time = 1
                 logger.error(f"OpenAI API error: {e}")
-                if attempt < max_retries:
-                    await asyncio.sleep(1)
-                    continue
-                return "My brain glitched, give me a sec 🫠"
+            await asyncio.sleep(wait_time)
+    
+    increment_daily_usage(cost)
+    if cache_key:
+        await storage.run(store_cached_response, cache_key, model, reply)
+    return reply
+
+def friendly_openai_error(error):
+    """Turn an OpenAI failure into something Summaria would say"""
+    if isinstance(error, scheduler.Rejected):
+        if error.reason == "budget":
+            return f"Hit my daily energy limit ({get_daily_usage()}/{DAILY_LIMIT}) 😴 Back tomorrow with fresh vibes!"
+        return "Everyone's talking to me at once rn, try again in a minute 💫"
+    if isinstance(error, asyncio.TimeoutError):
+        return "OpenAI is being slow right now, try again in a few minutes babe 🐌"
+    
+    error_str = str(error).lower()
+    if is_rate_limit_error(error) or "rate_limit" in error_str:
+        return "OpenAI is being slow right now, try again in a few minutes babe 🐌"
+    elif "context_length" in error_str:
+        return "That message was too long for my brain, try breaking it up? 🤯"
+    elif "content_policy" in error_str:
+        return "I can't respond to that bestie, let's keep it chill 😅"
+    
+    logger.error(f"OpenAI API error: {error}")
+    return "My brain glitched, give me a sec 🫠"
+
+async def create_streamed_completion(messages, on_text, model="gpt-4o", timeout=None, cost=1):
+    """Like create_completion, but streams the reply and calls on_text with the text so far as it grows"""
+    tokens = estimate_request_tokens(messages)
+    async with ai_scheduler.slot(cost):
+        await rate_limiter.acquire(tokens)
+        
+        async def read_stream():
+            try:
+                stream = await get_openai_client().chat.completions.create(model=model, messages=messages,
+                                                                           stream=True)
+            except Exception as e:
+                note_rate_limit(e)
+                raise
+            rate_limiter.update_from_headers(stream.response.headers)
+            parts = []
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    await on_text("".join(parts))
+            return "".join(parts)
+        
+        # The whole generation gets the same time budget as a plain completion
+        reply = await asyncio.wait_for(read_stream(), timeout=timeout or OPENAI_TIMEOUT)
+        # Streams don't report usage, so settle on an estimate of the reply
+        rate_limiter.settle(tokens, tokens - COMPLETION_TOKEN_ESTIMATE + estimate_tokens(reply))
+    return reply.strip()
+
+async def stream_completion(messages, on_text=None, model="gpt-4o", timeout=None, use_cache=True, cost=1):
+    """completion_with_retries that streams to on_text when it's given
+    
+    A stream that fails before any text arrives falls back to completion_with_retries
+    and its retries; once text has been shown the error is raised instead.
+    """
+    if on_text is None:
+        return await completion_with_retries(messages, model=model, timeout=timeout, use_cache=use_cache, cost=cost)
+    
+    cache_key = response_cache_key(model, messages) if use_cache and RESPONSE_CACHE_TTL > 0 else None
+    if cache_key:
+        cached = await storage.run(get_cached_response, cache_key)
+        if cached is not None:
+            logger.info("Response cache hit")
+            return cached
     
-    return "Something went wrong, try again later!"
+    shown = False
+    
+    async def track(text):
+        nonlocal shown
+        shown = True
+        await on_text(text)
+    
+    try:
+        reply = await create_streamed_completion(messages, track, model=model, timeout=timeout, cost=cost)
+    except scheduler.Rejected:
+        raise
+    except Exception as e:
+        if shown:
+            raise
+        logger.warning(f"Streaming failed before any text ({e}), retrying without streaming")
+        return await completion_with_retries(messages, model=model, timeout=timeout, use_cache=use_cache, cost=cost)
+    
+    increment_daily_usage(cost)
+    if cache_key:
+        await storage.run(store_cached_response, cache_key, model, reply)
+    return reply
+
+async def safe_openai_call(messages, model="gpt-4o", max_retries=2, timeout=None, use_cache=True, on_text=None):
+    """Make OpenAI API call with retry logic and error handling (streamed to on_text if given)"""
+    try:
+        if on_text:
+            return await stream_completion(messages, on_text, model=model, timeout=timeout, use_cache=use_cache)
+        return await completion_with_retries(messages, model=model, max_retries=max_retries, timeout=timeout,
+                                             use_cache=use_cache)
+    except Exception as e:
+        return friendly_openai_error(e)
 
-def is_daily_limit_reached():
-    """Check if daily AI usage limit is reached"""
-    return get_daily_usage() >= DAILY_LIMIT
+class StreamedReply:
+    """A placeholder reply that's edited as the answer streams in
+    
+    Edits are spaced at least STREAM_EDIT_INTERVAL apart (and back off when Telegram
+    says to), so a long answer costs a handful of edits rather than one per token.
+    """
+    
+    PLACEHOLDER = "✍️..."
+    CURSOR = " ▍"
+    
+    def __init__(self, msg):
+        self.msg = msg
+        self.sent = None
+        self.shown = ""
+        self.next_edit = 0.0
+    
+    async def start(self):
+        """Send the placeholder"""
+        try:
+            self.sent = await self.msg.reply_text(self.PLACEHOLDER)
+        except TelegramError as e:
+            logger.warning(f"Couldn't send streaming placeholder: {e}")
+        self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+    
+    async def update(self, text):
+        """Show the text so far, unless the last edit was too recent"""
+        if not self.sent or time.monotonic() < self.next_edit:
+            return
+        await self._edit(text[:TELEGRAM_MAX_TEXT - len(self.CURSOR)].rstrip() + self.CURSOR)
+    
+    async def finish(self, text):
+        """Show the final text, sending any overflow as extra messages"""
+        parts = [text[i:i + TELEGRAM_MAX_TEXT] for i in range(0, len(text), TELEGRAM_MAX_TEXT)] or [text]
+        if not self.sent or not await self._edit(parts[0], final=True):
+            await self.msg.reply_text(parts[0])
+        for part in parts[1:]:
+            await self.msg.reply_text(part)
+    
+    async def _edit(self, text, final=False):
+        if text == self.shown:
+            return True
+        for _ in range(2 if final else 1):
+            try:
+                await self.sent.edit_text(text)
+                self.shown = text
+                self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                return True
+            except RetryAfter as e:
+                self.next_edit = time.monotonic() + e.retry_after
+                if final:
+                    await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return True
+                logger.warning(f"Couldn't edit streamed reply: {e}")
+                return False
+            except TelegramError as e:
+                logger.warning(f"Couldn't edit streamed reply: {e}")
+                return False
+        return False
+
+def is_daily_limit_reached(cost=1):
+    """Check if daily AI usage limit is reached (or would be by a call of this cost)"""
+    return get_daily_usage() + cost > DAILY_LIMIT
 
 def init_db():
     """Initialize the database with required tables"""
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)  # 30 second timeout
+        conn = storage.get_connection()
         cursor = conn.cursor()
         
-        # Create basic tables
-        cursor.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
-        cursor.execute("CREATE TABLE IF NOT EXISTS nicknames (user_id TEXT PRIMARY KEY, name TEXT)")
-        
-        # Create memory table with original schema first
-        cursor.execute("""CREATE TABLE IF NOT EXISTS memory (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id TEXT,
-            user_id TEXT,
-            user_name TEXT,
-            message TEXT,
-            timestamp TEXT
-        )""")
-        
-        # Check if thread_id column exists, if not add it
-        cursor.execute("PRAGMA table_info(memory)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'thread_id' not in columns:
-            logger.info("Adding thread_id column to memory table")
-            cursor.execute("ALTER TABLE memory ADD COLUMN thread_id TEXT DEFAULT '0'")
-            cursor.execute("UPDATE memory SET thread_id = '0' WHERE thread_id IS NULL")
-        
-        cursor.execute("""CREATE TABLE IF NOT EXISTS user_preferences (
-            user_id TEXT PRIMARY KEY,
-            nickname TEXT,
-            personality_notes TEXT,
-            last_interaction TEXT,
-            interaction_count INTEGER DEFAULT 0
-        )""")
-        
-        # Add personal memory table for deeper relationships
-        cursor.execute("""CREATE TABLE IF NOT EXISTS personal_memories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            user_name TEXT,
-            memory_type TEXT,
-            memory_content TEXT,
-            emotional_weight INTEGER DEFAULT 1,
-            timestamp TEXT,
-            chat_id TEXT
-        )""")
-        
-        cursor.execute("""CREATE TABLE IF NOT EXISTS chat_context (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id TEXT,
-            thread_id TEXT,
-            topic TEXT,
-            last_updated TEXT,
-            message_count INTEGER DEFAULT 0
-        )""")
+        # Create or upgrade the schema
+        storage.migrate(conn)
         
         # Track when the bot was last started/updated with version info
         startup_time = datetime.now(timezone.utc).isoformat()
@@ -287,68 +762,118 @@ def init_db():
                            ('startup_notified', 'false'))
         
         conn.commit()
-        conn.close()
+        
+        # Everything else reads settings from the cache from here on
+        storage.settings.load(conn)
         return True
     
     return safe_db_operation(db_operation)
 
-def store_in_persistent_memory(chat_id, thread_id, user_id, user_name, message):
-    """Store message in persistent database"""
+def write_message_batch(rows):
+    """Write a batch of queued messages and their interaction counts in one transaction"""
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
+        conn = storage.get_connection()
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO memory (chat_id, thread_id, user_id, user_name, message, timestamp) VALUES (?, ?, ?, ?, ?, ?)", (
-            str(chat_id),
-            str(thread_id or 0),
-            str(user_id),
-            user_name,
-            message,
-            datetime.now(timezone.utc).isoformat()
-        ))
-        
-        # Update user interaction count
-        cursor.execute("""INSERT OR REPLACE INTO user_preferences 
-                         (user_id, nickname, personality_notes, last_interaction, interaction_count)
-                         VALUES (?, ?, 
-                                 COALESCE((SELECT personality_notes FROM user_preferences WHERE user_id = ?), ''),
-                                 ?, 
-                                 COALESCE((SELECT interaction_count FROM user_preferences WHERE user_id = ?), 0) + 1)""",
-                       (str(user_id), user_name, str(user_id), datetime.now(timezone.utc).isoformat(), str(user_id)))
+        cursor.executemany("INSERT INTO memory (chat_id, thread_id, user_id, user_name, message, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        
+        # Update user interaction counts - one upsert per user rather than per message
+        interactions = {}
+        for chat_id, thread_id, user_id, user_name, message, timestamp in rows:
+            count = interactions[user_id][2] + 1 if user_id in interactions else 1
+            interactions[user_id] = (user_name, timestamp, count)
+        cursor.executemany("""INSERT INTO user_preferences 
+                             (user_id, nickname, personality_notes, last_interaction, interaction_count)
+                             VALUES (?, ?, '', ?, ?)
+                             ON CONFLICT(user_id) DO UPDATE SET
+                                 nickname = excluded.nickname,
+                                 last_interaction = excluded.last_interaction,
+                                 interaction_count = interaction_count + excluded.interaction_count""",
+                           [(user_id, name, timestamp, count) for user_id, (name, timestamp, count) in interactions.items()])
         
         conn.commit()
-        conn.close()
         return True
     
     return safe_db_operation(db_operation)
 
-def store_personal_memory(user_id, user_name, memory_type, content, emotional_weight=1, chat_id=None):
-    """Store important personal memories about users"""
+message_writer = storage.WriteBehindQueue(write_message_batch, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL)
+
+def store_in_persistent_memory(chat_id, thread_id, user_id, user_name, message, timestamp=None):
+    """Queue message for the persistent database (written by message_writer)"""
+    user_contexts.note_message(int(user_id), user_name)
+    message_writer.put((
+        int(chat_id),
+        int(thread_id or 0),
+        int(user_id),
+        user_name,
+        message,
+        storage.to_ms(timestamp) if timestamp else storage.now_ms()
+    ))
+
+def write_personal_memory_batch(rows):
+    """Write a batch of queued personal memories, skipping ones already stored"""
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        
-        # Check if similar memory already exists
-        cursor.execute("""SELECT id FROM personal_memories 
-                         WHERE user_id = ? AND memory_type = ? AND memory_content LIKE ?""",
-                       (str(user_id), memory_type, f"%{content[:50]}%"))
-        
-        if not cursor.fetchone():  # Only store if not duplicate
-            cursor.execute("""INSERT INTO personal_memories 
-                             (user_id, user_name, memory_type, memory_content, emotional_weight, timestamp, chat_id)
-                             VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                           (str(user_id), user_name, memory_type, content, emotional_weight, 
-                            datetime.now(timezone.utc).isoformat(), str(chat_id or '')))
-            conn.commit()
-        
-        conn.close()
+        conn = storage.get_connection()
+        conn.executemany("""INSERT OR IGNORE INTO personal_memories 
+                            (user_id, user_name, memory_type, memory_content, emotional_weight, timestamp, chat_id, content_hash)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+        conn.commit()
+        return True
+    
+    return safe_db_operation(db_operation)
+
+personal_memory_writer = storage.WriteBehindQueue(write_personal_memory_batch, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL)
+
+def write_processed_batch(rows):
+    """Write a batch of processed message ids"""
+    def db_operation():
+        conn = storage.get_connection()
+        conn.executemany("INSERT OR IGNORE INTO processed_updates (chat_id, message_id, seen_at) VALUES (?, ?, ?)", rows)
+        conn.commit()
         return True
     
     return safe_db_operation(db_operation)
 
+processed_writer = storage.WriteBehindQueue(write_processed_batch, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL)
+
+def load_processed_messages():
+    """Reload message ids seen before the restart and drop expired ones"""
+    def db_operation():
+        conn = storage.get_connection()
+        cutoff = storage.now_ms() - DEDUP_TTL * 1000
+        conn.execute("DELETE FROM processed_updates WHERE seen_at <= ?", (cutoff,))
+        conn.commit()
+        return conn.execute("""SELECT chat_id, message_id, seen_at FROM processed_updates
+                               ORDER BY seen_at DESC LIMIT ?""", (DEDUP_MAX_SIZE,)).fetchall()
+    
+    rows = safe_db_operation(db_operation) or []
+    for chat_id, message_id, seen_at in reversed(rows):
+        processed_messages.add((chat_id, message_id), seen_at / 1000)
+    logger.info(f"Loaded {len(rows)} processed message ids")
+
+def already_processed(msg):
+    """Check-and-mark a message so a redelivered update is only handled once"""
+    key = (msg.chat_id, msg.message_id)
+    if processed_messages.check_and_add(key):
+        return True
+    if DEDUP_PERSIST:
+        processed_writer.put((msg.chat_id, msg.message_id, storage.now_ms()))
+    return False
+
+def store_personal_memory(user_id, user_name, memory_type, content, emotional_weight=1, chat_id=None):
+    """Queue an important personal memory about a user (duplicates are dropped on write)"""
+    timestamp = storage.now_ms()
+    user_contexts.note_memory(int(user_id), {"type": memory_type, "content": content,
+                                             "weight": emotional_weight, "timestamp": timestamp})
+    personal_memory_writer.put((
+        int(user_id), user_name, memory_type, content, emotional_weight,
+        timestamp, int(chat_id) if chat_id else None, storage.content_hash(content)
+    ))
+
 def get_personal_memories(user_id, limit=10):
     """Get personal memories about a specific user"""
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
+        personal_memory_writer.flush()  # Include memories still waiting in the write queue
+        conn = storage.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""SELECT memory_type, memory_content, emotional_weight, timestamp 
@@ -356,7 +881,7 @@ def get_personal_memories(user_id, limit=10):
                          WHERE user_id = ? 
                          ORDER BY emotional_weight DESC, timestamp DESC 
                          LIMIT ?""",
-                       (str(user_id), limit))
+                       (int(user_id), limit))
         
         memories = []
         for row in cursor.fetchall():
@@ -367,152 +892,323 @@ def get_personal_memories(user_id, limit=10):
                 "timestamp": row[3]
             })
         
-        conn.close()
         return memories
     
     result = safe_db_operation(db_operation)
     return result if result else []
 
-def analyze_message_for_memories(user_id, user_name, message_text, chat_id):
-    """Analyze message for important personal information to remember"""
-    text_lower = message_text.lower()
-    
+# (memory_type, label, emotional_weight, phrases, also_needs) - a message can match several rules,
+# and a rule with also_needs only fires if one of those phrases appears too
+MEMORY_RULES = [
     # Emotional expressions (high weight)
-    if any(phrase in text_lower for phrase in ["love you", "i love", "love summaria", "love u"]):
-        store_personal_memory(user_id, user_name, "affection", f"Expressed love: {message_text[:100]}", 5, chat_id)
-    
-    if any(phrase in text_lower for phrase in ["miss you", "missed you", "thinking about you"]):
-        store_personal_memory(user_id, user_name, "affection", f"Expressed missing: {message_text[:100]}", 4, chat_id)
-    
+    ("affection", "Expressed love", 5, ["love you", "i love", "love summaria", "love u"], None),
+    ("affection", "Expressed missing", 4, ["miss you", "missed you", "thinking about you"], None),
     # Personal life events (high weight)
-    if any(phrase in text_lower for phrase in ["broke up", "relationship ended", "single now", "got dumped"]):
-        store_personal_memory(user_id, user_name, "relationship", f"Relationship status change: {message_text[:100]}", 5, chat_id)
-    
-    if any(phrase in text_lower for phrase in ["new job", "got hired", "promotion", "new position"]):
-        store_personal_memory(user_id, user_name, "career", f"Career update: {message_text[:100]}", 4, chat_id)
-    
-    if any(phrase in text_lower for phrase in ["birthday", "bday", "turning", "years old"]):
-        store_personal_memory(user_id, user_name, "personal", f"Birthday mention: {message_text[:100]}", 4, chat_id)
-    
+    ("relationship", "Relationship status change", 5, ["broke up", "relationship ended", "single now", "got dumped"], None),
+    ("career", "Career update", 4, ["new job", "got hired", "promotion", "new position"], None),
+    ("personal", "Birthday mention", 4, ["birthday", "bday", "turning", "years old"], None),
     # Health/wellness (medium weight)
-    if any(phrase in text_lower for phrase in ["started tirz", "first injection", "week 1", "starting dose"]):
-        store_personal_memory(user_id, user_name, "health", f"Tirz journey: {message_text[:100]}", 3, chat_id)
-    
-    if any(phrase in text_lower for phrase in ["goal weight", "lost", "pounds", "lbs", "kg"]) and any(num in text_lower for num in ["10", "20", "30", "40", "50"]):
-        store_personal_memory(user_id, user_name, "health", f"Weight/goal update: {message_text[:100]}", 3, chat_id)
-    
+    ("health", "Tirz journey", 3, ["started tirz", "first injection", "week 1", "starting dose"], None),
+    ("health", "Weight/goal update", 3, ["goal weight", "lost", "pounds", "lbs", "kg"], ["10", "20", "30", "40", "50"]),
     # Personal preferences (low weight)
-    if any(phrase in text_lower for phrase in ["favorite", "love this", "obsessed with", "addicted to"]):
-        store_personal_memory(user_id, user_name, "preferences", f"Likes: {message_text[:100]}", 2, chat_id)
-    
+    ("preferences", "Likes", 2, ["favorite", "love this", "obsessed with", "addicted to"], None),
     # Family/pets (medium weight)
-    if any(phrase in text_lower for phrase in ["my dog", "my cat", "my pet", "my husband", "my boyfriend", "my kids"]):
-        store_personal_memory(user_id, user_name, "family", f"Family/pets: {message_text[:100]}", 3, chat_id)
+    ("family", "Family/pets", 3, ["my dog", "my cat", "my pet", "my husband", "my boyfriend", "my kids"], None),
+]
+
+def trie_regex(phrases):
+    """Regex source matching any of the phrases, nested as a trie so shared prefixes are tried once
+    
+    Optional tails are greedy, so at any position it matches the longest phrase.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+    
+    return build(trie)
+
+def compile_memory_rules(rules):
+    """Build one regex that finds every rule phrase in a single pass
+    
+    Each match is a zero-width lookahead, so matches can overlap, and the longest
+    phrase at each position wins. Any other phrase matching at that position is a
+    prefix of the longest one, so each phrase maps to the tags of all its prefixes.
+    Returns (pattern, phrase -> tags), where a tag is ("rule", index) or ("needs", index).
+    """
+    owners = defaultdict(set)
+    for index, (_, _, _, phrases, also_needs) in enumerate(rules):
+        for phrase in phrases:
+            owners[phrase].add(("rule", index))
+        for phrase in also_needs or []:
+            owners[phrase].add(("needs", index))
+    
+    tags = {
+        phrase: frozenset().union(*(owners[other] for other in owners if phrase.startswith(other)))
+        for phrase in owners
+    }
+    return re.compile(f"(?=({trie_regex(owners)}))"), tags
+
+memory_rule_pattern, memory_rule_tags = compile_memory_rules(MEMORY_RULES)
+
+def analyze_message_for_memories(user_id, user_name, message_text, chat_id):
+    """Analyze message for important personal information to remember"""
+    found = set()
+    for match in memory_rule_pattern.finditer(message_text.lower()):
+        found |= memory_rule_tags[match.group(1)]
+    if not found:
+        return
+    
+    for index, (memory_type, label, weight, _, also_needs) in enumerate(MEMORY_RULES):
+        if ("rule", index) in found and (not also_needs or ("needs", index) in found):
+            store_personal_memory(user_id, user_name, memory_type, f"{label}: {message_text[:100]}", weight, chat_id)
 
 def get_user_context(user_id):
-    """Get context about a specific user including personal memories"""
+    """Get context about a specific user including personal memories (from user_contexts when cached)"""
+    user_id = int(user_id)
+    context = user_contexts.get(user_id)
+    if context is not None:
+        return context
+    
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        cursor.execute("SELECT nickname, personality_notes, interaction_count FROM user_preferences WHERE user_id = ?", 
-                       (str(user_id),))
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            basic_context = {
-                "nickname": row[0],
-                "notes": row[1] or "",
-                "interaction_count": row[2] or 0
-            }
-        else:
-            basic_context = {"nickname": None, "notes": "", "interaction_count": 0}
-        
-        # Add personal memories
-        memories = get_personal_memories(user_id, limit=8)
-        basic_context["memories"] = memories
-        
-        return basic_context
+        # Pending writes go first so the snapshot matches what note_message/note_memory will add to
+        message_writer.flush()
+        personal_memory_writer.flush()
+        conn = storage.get_connection()
+        row = conn.execute("SELECT nickname, personality_notes, interaction_count FROM user_preferences WHERE user_id = ?",
+                           (user_id,)).fetchone()
+        memories = conn.execute("""SELECT memory_type, memory_content, emotional_weight, timestamp
+                                   FROM personal_memories
+                                   WHERE user_id = ?
+                                   ORDER BY emotional_weight DESC, timestamp DESC
+                                   LIMIT ?""", (user_id, USER_CONTEXT_MEMORIES)).fetchall()
+        return {
+            "nickname": row[0] if row else None,
+            "notes": (row[1] if row else None) or "",
+            "interaction_count": (row[2] if row else None) or 0,
+            "memories": [{"type": m[0], "content": m[1], "weight": m[2], "timestamp": m[3]} for m in memories]
+        }
     
     result = safe_db_operation(db_operation)
-    if not result:
-        result = {"nickname": None, "notes": "", "interaction_count": 0, "memories": []}
-        result["memories"] = get_personal_memories(user_id, limit=8)
-    
+    if result is None:
+        return {"nickname": None, "notes": "", "interaction_count": 0, "memories": []}
+    user_contexts.put(user_id, result)
     return result
 
-def get_recent_chat_context(chat_id, limit=10):
-    """Get recent context from this chat for better AI responses"""
+async def load_user_context(user_id):
+    """get_user_context without leaving the event loop when the snapshot is cached"""
+    context = user_contexts.get(int(user_id))
+    if context is not None:
+        return context
+    return await storage.run(get_user_context, user_id)
+
+class ContextWindow:
+    """Recent chat lines, fed newest first, that stops taking them once the conversation is covered
+    
+    The window closes at the token budget or CHAT_CONTEXT_MAX_MESSAGES, at
+    CHAT_CONTEXT_MAX_AGE, or - once it has CHAT_CONTEXT_MIN_MESSAGES - at a lull
+    longer than CHAT_CONTEXT_GAP. A busy topic fills it with the last few minutes,
+    a quiet one reaches back to where its conversation started.
+    """
+    
+    def __init__(self, max_tokens, now=None):
+        self.max_tokens = max_tokens
+        self.horizon = (now or time.time()) - CHAT_CONTEXT_MAX_AGE
+        self.lines = []  # Newest first
+        self.tokens = 0
+        self.oldest = None
+        self.closed = False
+    
+    def add(self, user_name, text, timestamp):
+        """Take one older message, returns False once the window is closed"""
+        if self.closed:
+            return False
+        line = f"{user_name}: {text}"
+        tokens = prompts.count_tokens(line) + 1
+        if timestamp < self.horizon or self.tokens + tokens > self.max_tokens \
+                or (len(self.lines) >= CHAT_CONTEXT_MIN_MESSAGES and self.oldest - timestamp > CHAT_CONTEXT_GAP):
+            self.closed = True
+            return False
+        self.lines.append(line)
+        self.tokens += tokens
+        self.oldest = timestamp
+        self.closed = len(self.lines) >= CHAT_CONTEXT_MAX_MESSAGES
+        return not self.closed
+    
+    def result(self):
+        return list(reversed(self.lines))
+
+def get_recent_chat_context(chat_id, thread_id, before, since, limit):
+    """Messages in one topic from since up to before (epoch seconds) as (user_name, message, timestamp), newest first"""
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        
-        # Get recent messages for context
-        cursor.execute("""SELECT user_name, message FROM memory 
-                         WHERE chat_id = ? 
-                         ORDER BY timestamp DESC LIMIT ?""", 
-                       (str(chat_id), limit))
-        
-        recent_messages = []
-        for row in cursor.fetchall():
-            recent_messages.append(f"{row[0]}: {row[1]}")
-        
-        conn.close()
-        return "\n".join(reversed(recent_messages)) if recent_messages else ""
+        conn = storage.get_connection()
+        # Served by idx_memory_chat_thread_ts
+        rows = conn.execute("""SELECT user_name, message, timestamp FROM memory
+                               WHERE chat_id = ? AND thread_id = ? AND timestamp < ? AND timestamp >= ?
+                               ORDER BY timestamp DESC LIMIT ?""",
+                            (int(chat_id), int(thread_id or 0), storage.to_ms(before), storage.to_ms(since),
+                             limit)).fetchall()
+        return [(name, message, ts / 1000) for name, message, ts in rows]
     
     result = safe_db_operation(db_operation)
-    return result if result else ""
+    return result if result else []
 
-def init_personality():
+async def load_recent_chat_context(chat_id, thread_id, max_tokens=CHAT_CONTEXT_MAX_TOKENS):
+    """Recent "name: message" lines from this topic, oldest first, sized by ContextWindow
+    
+    Comes from the in-memory history, going to the database only for the part of
+    the window from before this process (or the history's size cap) dropped it.
+    """
+    window = ContextWindow(max_tokens)
+    key = (chat_id, thread_id or 0)
+    history = chat_history.get(key)
+    covered_from = history_covered_from(key)
+    if history:
+        for i in range(len(history) - 1, -1, -1):
+            entry = history[i]
+            if not window.add(entry.user, entry.text, entry.timestamp):
+                break
+    
+    if not window.closed and covered_from > window.horizon:
+        before = window.oldest if window.oldest is not None else covered_from
+        older = await storage.run(get_recent_chat_context, chat_id, thread_id, before, window.horizon,
+                                  CHAT_CONTEXT_MAX_MESSAGES - len(window.lines))
+        for user_name, text, timestamp in older:
+            if not window.add(user_name, text, timestamp):
+                break
+        logger.debug(f"Chat context for {chat_id}/{thread_id or 0}: {len(older)} older messages from the database")
+    return window.result()
+
+def fts_query(text):
+    """Turn what someone typed into an FTS5 query: every word must appear, the last one as a prefix
+    
+    Words are quoted so punctuation (7.5mg, can't) is matched as a phrase instead of
+    being read as query syntax.
+    """
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def search_messages(chat_id, thread_id, text, limit=SEARCH_RESULTS):
+    """Best matches for text in one topic, as (user_name, timestamp, snippet) rows"""
+    query = fts_query(text)
+    if not query:
+        return []
+    
     def db_operation():
-        init_db()
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'personality'")
-        row = cursor.fetchone()
-        if not row:
-            mood = random.choice(PERSONALITIES)
-            cursor.execute("INSERT INTO settings (key, value) VALUES (?, ?)", ('personality', mood))
-            conn.commit()
-            conn.close()
-            return mood
-        conn.close()
-        return row[0]
+        message_writer.flush()  # Include messages still waiting in the write queue
+        conn = storage.get_connection()
+        return conn.execute("""SELECT m.user_name, m.timestamp, snippet(memory_fts, 0, '«', '»', '…', 16)
+                               FROM memory_fts JOIN memory m ON m.id = memory_fts.rowid
+                               WHERE memory_fts MATCH ? AND m.chat_id = ? AND m.thread_id = ?
+                               ORDER BY rank LIMIT ?""",
+                            (query, int(chat_id), int(thread_id or 0), limit)).fetchall()
     
-    result = safe_db_operation(db_operation)
-    return result if result else random.choice(PERSONALITIES)
+    return safe_db_operation(db_operation)
 
-def reset_personality():
+def open_vector_index():
+    """Open this process's vector index file (one per worker in multi-worker mode)"""
+    path = embeddings.EMBEDDING_INDEX_PATH or f"{storage.MEMORY_DB}-vec"
+    if sharding.is_worker():
+        path += f"-{sharding.WORKER_INDEX}"
+    return embeddings.VectorIndex(path)
+
+def sync_vector_index():
+    """Embed messages and memories written since the last sync, returns rows read"""
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        mood = random.choice(PERSONALITIES)
-        cursor.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", ('personality', mood))
-        conn.commit()
-        conn.close()
+        message_writer.flush()
+        personal_memory_writer.flush()
+        return embeddings.sync(vector_index, storage.get_connection(), storage.BOT_USER_ID,
+                               owns_chat=sharding.owns_chat)
+    
+    return safe_db_operation(db_operation) or 0
+
+async def vector_sync_loop():
+    """Keep the vector index caught up with the database"""
+    while True:
+        try:
+            # Full batches mean there's more waiting (e.g. the whole history on first start)
+            while await storage.run(sync_vector_index) >= embeddings.SYNC_BATCH_SIZE:
+                await asyncio.sleep(0)
+        except Exception as e:
+            logger.error(f"Vector index sync failed: {e}")
+        await asyncio.sleep(EMBEDDING_SYNC_INTERVAL)
+
+def retrieve_context(chat_id, thread_id, user_id, query):
+    """Older messages from this topic and memories of this user that look related to query
+    
+    Returns (messages, memories) - (user_name, message, timestamp) rows and memory dicts,
+    best match first.
+    """
+    if vector_index is None or not query:
+        return [], []
+    message_hits = vector_index.search(query, embeddings.KIND_MESSAGE, RETRIEVAL_TOP_K * 2, chat_id=int(chat_id),
+                                       thread_id=int(thread_id or 0), min_score=RETRIEVAL_MIN_SCORE)
+    memory_hits = vector_index.search(query, embeddings.KIND_MEMORY, RETRIEVAL_TOP_K, user_id=int(user_id),
+                                      min_score=RETRIEVAL_MIN_SCORE)
+    if not message_hits and not memory_hits:
+        return [], []
+    
+    def db_operation():
+        conn = storage.get_connection()
+        message_ids = [ref for _, ref in message_hits]
+        memory_ids = [ref for _, ref in memory_hits]
+        messages = {row[0]: row[1:] for row in conn.execute(
+            f"SELECT id, user_name, message, timestamp FROM memory WHERE id IN ({','.join('?' * len(message_ids))})",
+            message_ids)} if message_ids else {}
+        memories = {row[0]: {"type": row[1], "content": row[2], "weight": row[3], "timestamp": row[4]}
+                    for row in conn.execute(f"""SELECT id, memory_type, memory_content, emotional_weight, timestamp
+                                                FROM personal_memories WHERE id IN ({','.join('?' * len(memory_ids))})""",
+                                            memory_ids)} if memory_ids else {}
+        # Rows removed since they were indexed just drop out
+        return ([messages[ref] for ref in message_ids if ref in messages],
+                [memories[ref] for ref in memory_ids if ref in memories])
+    
+    return safe_db_operation(db_operation) or ([], [])
+
+def init_personality():
+    """Get the current mood from the settings cache, picking one if there isn't one"""
+    mood = storage.settings.get('personality')
+    if mood:
         return mood
     
-    result = safe_db_operation(db_operation)
-    return result if result else random.choice(PERSONALITIES)
+    mood = random.choice(PERSONALITIES)
+    safe_db_operation(lambda: storage.settings.set('personality', mood))
+    return mood
+
+def reset_personality():
+    mood = random.choice(PERSONALITIES)
+    safe_db_operation(lambda: storage.settings.set('personality', mood))
+    return mood
 
 def get_nickname(user_id):
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
+        conn = storage.get_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT name FROM nicknames WHERE user_id = ?", (str(user_id),))
+        cursor.execute("SELECT name FROM nicknames WHERE user_id = ?", (int(user_id),))
         row = cursor.fetchone()
-        conn.close()
         return row[0] if row else None
     
     return safe_db_operation(db_operation)
 
 def set_nickname(user_id, name):
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
+        conn = storage.get_connection()
         cursor = conn.cursor()
-        cursor.execute("REPLACE INTO nicknames (user_id, name) VALUES (?, ?)", (str(user_id), name))
+        cursor.execute("REPLACE INTO nicknames (user_id, name) VALUES (?, ?)", (int(user_id), name))
         conn.commit()
-        conn.close()
         return True
     
     return safe_db_operation(db_operation)
@@ -533,76 +1229,133 @@ def is_on_command_cooldown(user_id):
     cooldowns[command_cooldowns_key] = now
     return False
 
+class UsageCounter:
+    """Daily AI usage kept in memory and checkpointed to the daily_usage table
+    
+    add() only touches memory. checkpoint() adds the pending amounts to the stored
+    counts with an UPSERT and reads the totals back, so it stays correct when
+    another process is counting against the same database.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()  # One checkpoint at a time, so pending is saved once
+        self._stored = {}   # day -> total last read back from the database
+        self._pending = {}  # day -> usage not yet checkpointed (including any being saved right now)
+    
+    @staticmethod
+    def today():
+        return datetime.now(timezone.utc).date().isoformat()
+    
+    def get(self, day=None):
+        day = day or self.today()
+        with self._lock:
+            return self._stored.get(day, 0) + self._pending.get(day, 0)
+    
+    def add(self, cost=1):
+        """Count a call of the given cost toward today, returns the new total"""
+        day = self.today()
+        with self._lock:
+            self._pending[day] = self._pending.get(day, 0) + cost
+            return self._stored.get(day, 0) + self._pending[day]
+    
+    def load(self):
+        """Read today's stored total"""
+        def db_operation():
+            conn = storage.get_connection()
+            row = conn.execute("SELECT count FROM daily_usage WHERE day = ?", (self.today(),)).fetchone()
+            return row[0] if row else 0
+        
+        result = safe_db_operation(db_operation)
+        if result is not None:
+            with self._lock:
+                self._stored[self.today()] = result
+    
+    def checkpoint(self):
+        """Save pending usage to the database"""
+        with self._checkpoint_lock:
+            return self._checkpoint()
+    
+    def _checkpoint(self):
+        # pending stays counted in get() until the saved totals replace it below
+        with self._lock:
+            pending = dict(self._pending)
+        if not pending:
+            # Nothing to add, but other processes may have counted since the last read
+            self.load()
+            return True
+        
+        def db_operation():
+            conn = storage.get_connection()
+            totals = {}
+            for day, amount in pending.items():
+                totals[day] = conn.execute("""INSERT INTO daily_usage (day, count) VALUES (?, ?)
+                                              ON CONFLICT(day) DO UPDATE SET count = count + excluded.count
+                                              RETURNING count""", (day, amount)).fetchone()[0]
+            conn.commit()
+            return totals
+        
+        totals = safe_db_operation(db_operation)
+        with self._lock:
+            if totals is None:
+                # The usage is still pending, so the next checkpoint tries again
+                return False
+            for day, amount in pending.items():
+                left = self._pending.get(day, 0) - amount
+                if left:
+                    self._pending[day] = left
+                else:
+                    self._pending.pop(day, None)
+            self._stored.update(totals)
+            # Only today's total is ever read again
+            today = self.today()
+            self._stored = {day: total for day, total in self._stored.items() if day == today}
+        return True
+
+daily_usage = UsageCounter()
+
 def get_daily_usage():
     """Get today's AI usage count"""
-    def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        today = datetime.now(timezone.utc).date().isoformat()
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (f"daily_usage_{today}",))
-        row = cursor.fetchone()
-        conn.close()
-        return int(row[0]) if row else 0
-    
-    result = safe_db_operation(db_operation)
-    return result if result is not None else 0
+    return daily_usage.get()
 
-def increment_daily_usage():
-    """Increment today's usage count"""
-    def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        today = datetime.now(timezone.utc).date().isoformat()
-        current = get_daily_usage()
-        cursor.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", 
-                       (f"daily_usage_{today}", str(current + 1)))
-        conn.commit()
-        conn.close()
-        return current + 1
-    
-    result = safe_db_operation(db_operation)
-    return result if result is not None else 0
+def increment_daily_usage(cost=1):
+    """Increment today's usage count by the cost of the call"""
+    return daily_usage.add(cost)
+
+async def usage_checkpoint_loop():
+    """Periodically save the in-memory usage counters and pick up other workers' usage"""
+    while True:
+        await asyncio.sleep(USAGE_CHECKPOINT_INTERVAL)
+        try:
+            await storage.run(daily_usage.checkpoint)
+            if sharding.is_worker():
+                # Settings (e.g. a /resetmood) and user contexts may have been changed by another worker
+                await storage.run(storage.settings.load)
+                user_contexts.invalidate()
+        except Exception as e:
+            logger.error(f"Usage checkpoint failed: {e}")
 
 def get_startup_time():
     """Get when the bot was last started"""
-    def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'last_startup'")
-        row = cursor.fetchone()
-        conn.close()
-        if row:
-            return datetime.fromisoformat(row[0])
-        return datetime.now(timezone.utc)
-    
-    result = safe_db_operation(db_operation)
-    return result if result else datetime.now(timezone.utc)
+    try:
+        last_startup = storage.settings.get('last_startup')
+        if last_startup:
+            return datetime.fromisoformat(last_startup)
+    except Exception as e:
+        logger.error(f"Error reading startup time: {e}")
+    return datetime.now(timezone.utc)
 
 def is_startup_notified():
     """Check if users have been notified about startup"""
-    def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'startup_notified'")
-        row = cursor.fetchone()
-        conn.close()
-        return row and row[0] == 'true'
-    
-    result = safe_db_operation(db_operation)
-    return result if result is not None else False
+    try:
+        return storage.settings.get('startup_notified') == 'true'
+    except Exception as e:
+        logger.error(f"Error reading startup_notified: {e}")
+        return False
 
 def mark_startup_notified():
     """Mark that users have been notified about startup"""
-    def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
-        cursor = conn.cursor()
-        cursor.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", 
-                       ('startup_notified', 'true'))
-        conn.commit()
-        conn.close()
-        return True
-    
-    return safe_db_operation(db_operation)
+    return safe_db_operation(lambda: storage.settings.set('startup_notified', 'true'))
 
 def graceful_shutdown():
     """Handle graceful shutdown"""
@@ -616,6 +1369,31 @@ def graceful_shutdown():
         logger.info("Memory cleanup completed")
     except Exception as e:
         logger.error(f"Error during shutdown cleanup: {e}")
+    
+    # Save usage counted since the last checkpoint
+    try:
+        daily_usage.checkpoint()
+    except Exception as e:
+        logger.error(f"Error saving daily usage: {e}")
+    
+    # Write out anything still sitting in the write queue
+    try:
+        written = message_writer.flush() + personal_memory_writer.flush() + processed_writer.flush()
+        logger.info(f"Flushed {written} queued rows")
+    except Exception as e:
+        logger.error(f"Error flushing queued rows: {e}")
+    
+    if vector_index is not None:
+        try:
+            vector_index.flush()
+        except Exception as e:
+            logger.error(f"Error saving the vector index: {e}")
+    
+    try:
+        storage.close_all()
+        logger.info("Database connections closed")
+    except Exception as e:
+        logger.error(f"Error closing database connections: {e}")
 
 def signal_handler(signum, frame):
     """Handle shutdown signals"""
@@ -644,7 +1422,16 @@ def get_time_since_startup():
         days = int(time_since.total_seconds() / 86400)
         return f"{days} day{'s' if days != 1 else ''} ago"
 
-def store_message(update: Update):
+def append_to_history(key, user, text):
+    """Add a message to a topic's in-memory history, expiring its old entries as we go"""
+    now = time.time()
+    history = chat_history[key]
+    history.expire(now - HISTORY_MAX_AGE)
+    entry = HistoryEntry(now, user, text)
+    history.append(entry)
+    return entry
+
+async def store_message(update: Update):
     """Store message in both memory and persistent storage"""
     msg = update.message
     if msg and (msg.text or msg.caption):
@@ -653,103 +1440,281 @@ def store_message(update: Update):
         
         # Use message_thread_id for topics (General, Fashion, etc.)
         key = (msg.chat_id, msg.message_thread_id or 0)
-        chat_history[key].append({
-            "timestamp": datetime.now(timezone.utc),
-            "user": msg.from_user.first_name,
-            "text": message_text.strip()
-        })
+        entry = append_to_history(key, msg.from_user.first_name, message_text.strip())
         
-        # Store in persistent database with topic info
+        # Store in persistent database with topic info (same timestamp as in memory)
         store_in_persistent_memory(
             msg.chat_id, 
             msg.message_thread_id or 0,
             msg.from_user.id,
             msg.from_user.first_name,
-            message_text.strip()
+            message_text.strip(),
+            timestamp=entry.timestamp
         )
         
         # Debug logging with topic info
         topic_name = "General" if not msg.message_thread_id else f"Topic-{msg.message_thread_id}"
         logger.info(f"Stored message from {msg.from_user.first_name} in chat {msg.chat_id}, topic: {topic_name}")
 
-def store_bot_message(chat_id, thread_id, message_text):
+async def store_bot_message(chat_id, thread_id, message_text):
     """Store bot's own messages so it can remember what it said"""
     key = (chat_id, thread_id or 0)
-    chat_history[key].append({
-        "timestamp": datetime.now(timezone.utc),
-        "user": "Summaria",
-        "text": message_text.strip()
-    })
+    entry = append_to_history(key, "Summaria", message_text.strip())
     
     # Also store in persistent memory
     store_in_persistent_memory(
         chat_id, 
         thread_id or 0,
-        "bot",
+        storage.BOT_USER_ID,
         "Summaria", 
-        message_text.strip()
+        message_text.strip(),
+        timestamp=entry.timestamp
     )
 
-def get_recent_messages(chat_id, thread_id, duration_minutes=180):
-    """Get recent messages from the specified thread/topic"""
-    key = (chat_id, thread_id or 0)
-    now = datetime.now(timezone.utc)
+async def get_recent_messages(chat_id, thread_id, duration_minutes=180):
+    """Get recent messages from the specified thread/topic
     
-    # Try in-memory first
-    memory_msgs = [
-        entry for entry in chat_history[key]
-        if (now - entry["timestamp"]).total_seconds() <= duration_minutes * 60
-    ]
+    The in-memory history answers only when it holds the whole window (see
+    history_covered_from); otherwise the window is read from persistent storage.
+    """
+    key = (chat_id, thread_id or 0)
+    cutoff = time.time() - duration_minutes * 60
+    history = chat_history.get(key)
+    memory_msgs = history.since(cutoff) if history else []
     
     topic_name = "General" if not thread_id else f"Topic-{thread_id}"
     logger.info(f"Looking for messages in {topic_name}: found {len(memory_msgs)} in memory")
     
-    # If we have enough in memory, use those
-    if len(memory_msgs) > 3:
+    # Memory has every message of the window unless its start was capped off or came before this process.
+    # Bulk windows reach far past HISTORY_MAX_AGE, so they always take the indexed query
+    if duration_minutes <= TLDR_BULK_MINUTES and history_covered_from(key) <= cutoff:
         logger.info(f"Using {len(memory_msgs)} in-memory messages from {topic_name}")
         return memory_msgs
     
-    # Otherwise try persistent storage for this specific topic
+    # Otherwise read the window from persistent storage for this specific topic
     logger.info(f"Checking persistent storage for {topic_name}...")
     
     def db_operation():
-        conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
+        message_writer.flush()  # Include messages still waiting in the write queue
+        conn = storage.get_connection()
         cursor = conn.cursor()
         
-        cutoff_time = (datetime.now(timezone.utc) - timedelta(minutes=duration_minutes)).isoformat()
-        
         # Get messages for this specific chat and thread
         cursor.execute("""SELECT user_name, message, timestamp FROM memory 
                          WHERE chat_id = ? AND thread_id = ? AND timestamp > ?
                          ORDER BY timestamp ASC""", 
-                       (str(chat_id), str(thread_id or 0), cutoff_time))
+                       (int(chat_id), int(thread_id or 0), storage.to_ms(cutoff)))
         
-        messages = []
-        for row in cursor.fetchall():
-            user_name, message, timestamp_str = row
-            try:
-                timestamp = datetime.fromisoformat(timestamp_str)
-                messages.append({
-                    "timestamp": timestamp,
-                    "user": user_name,
-                    "text": message
-                })
-            except:
-                continue
+        messages = [
+            HistoryEntry(timestamp_ms / 1000, user_name, message)
+            for user_name, message, timestamp_ms in cursor.fetchall()
+        ]
         
-        conn.close()
         return messages
     
-    db_messages = safe_db_operation(db_operation)
-    if not db_messages:
-        db_messages = []
+    db_messages = await storage.run(safe_db_operation, db_operation)
+    if db_messages is None:
+        # Storage failed, so the part of the window still in memory is the best we have
+        return memory_msgs
     
     logger.info(f"Found {len(db_messages)} persistent messages from {topic_name}")
+    return db_messages
+
+def tldr_style_prompt(mood):
+    return f"You summarize Telegram group chats like a sassy friend. Keep it natural and conversational, not formal. You're {mood} today. No bullet points - just tell the story of what happened in this topic."
+
+def estimate_tokens(text):
+    """Token count - exact when tiktoken is available (see prompts.count_tokens)"""
+    return prompts.count_tokens(text)
+
+def chunk_conversation(lines, max_tokens=TLDR_CHUNK_TOKENS):
+    """Split conversation lines into chunks of at most max_tokens
+    
+    Once a chunk is half full it also ends after any line whose hash hits a fixed
+    pattern. Those boundaries depend only on the messages themselves, so two
+    overlapping windows cut the shared stretch the same way and reuse each
+    other's chunk summaries.
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in lines:
+        line_tokens = estimate_tokens(line)
+        if current and current_tokens + line_tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+        if current_tokens >= max_tokens // 2 and hashlib.blake2b(line.encode("utf-8"), digest_size=1).digest()[0] % 8 == 0:
+            chunks.append(current)
+            current, current_tokens = [], 0
+    if current:
+        chunks.append(current)
+    return chunks
+
+chunk_summary_cache = OrderedDict()
+
+async def summarize_chunk(lines, topic_name):
+    """Neutral notes for one chunk of the conversation"""
+    text = "\n".join(lines)
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    if key in chunk_summary_cache:
+        chunk_summary_cache.move_to_end(key)
+        return chunk_summary_cache[key]
     
-    # Return whichever has more messages
-    if len(db_messages) > len(memory_msgs):
-        return db_messages
-    return memory_msgs
+    messages = [
+        {"role": "system", "content": "You take notes on part of a Telegram group chat. Write a short plain summary of who said what and what happened, keeping names, numbers, doses and decisions. No commentary."},
+        {"role": "user", "content": f"Chat excerpt from {topic_name}:\n{text}"}
+    ]
+    summary = await completion_with_retries(messages)
+    
+    chunk_summary_cache[key] = summary
+    if len(chunk_summary_cache) > TLDR_CHUNK_CACHE_SIZE:
+        chunk_summary_cache.popitem(last=False)
+    return summary
+
+async def merge_summaries(summaries, topic_name):
+    """Combine consecutive partial summaries into one set of notes"""
+    joined = "\n\n".join(f"Part {i + 1}:\n{summary}" for i, summary in enumerate(summaries))
+    messages = [
+        {"role": "system", "content": "You combine consecutive notes about a Telegram group chat into one shorter set of notes, in order. Keep names, numbers and decisions. No commentary."},
+        {"role": "user", "content": f"Notes from {topic_name}:\n{joined}"}
+    ]
+    return await completion_with_retries(messages)
+
+async def gather_limited(func, arg_tuples, limit=TLDR_FANOUT):
+    """func(*args) for each args, at most limit at a time, results in order
+    
+    Keeps one request's fan-out from filling the scheduler's queue on its own. The
+    first failure cancels the calls still running or waiting, then is raised.
+    """
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def run(args):
+        async with semaphore:
+            return await func(*args)
+    
+    tasks = [asyncio.create_task(run(args)) for args in arg_tuples]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def summarize_conversation(lines, topic_name, mood, on_text=None):
+    """Summarize a topic's conversation
+    
+    Short conversations go out in one request. Longer ones are chunked, the chunks
+    summarized in parallel (TLDR_FANOUT at a time), and the notes merged (in rounds of TLDR_MERGE_FANIN)
+    before the final sassy retelling. Only the final request is streamed to on_text.
+    """
+    style = tldr_style_prompt(mood)
+    
+    chunks = chunk_conversation(lines)
+    if len(chunks) == 1:
+        messages = [
+            {"role": "system", "content": style},
+            {"role": "user", "content": f"Summarize this chat from {topic_name}:\n" + "\n".join(lines)}
+        ]
+        return await stream_completion(messages, on_text)
+    
+    skipped = 0
+    if len(chunks) > TLDR_MAX_CHUNKS:
+        # Keep the cost bounded - the most recent part of the window matters most
+        skipped = len(chunks) - TLDR_MAX_CHUNKS
+        chunks = chunks[-TLDR_MAX_CHUNKS:]
+    logger.info(f"TLDR map-reduce: {len(chunks)} chunks ({skipped} older chunks skipped)")
+    
+    summaries = await gather_limited(summarize_chunk, [(chunk, topic_name) for chunk in chunks])
+    
+    while len(summaries) > TLDR_MERGE_FANIN:
+        groups = [summaries[i:i + TLDR_MERGE_FANIN] for i in range(0, len(summaries), TLDR_MERGE_FANIN)]
+        summaries = await gather_limited(merge_summaries, [(group, topic_name) for group in groups])
+    
+    notes = "\n\n".join(summaries)
+    if skipped:
+        notes = "(The earliest part of this window was too long to include.)\n\n" + notes
+    messages = [
+        {"role": "system", "content": style},
+        {"role": "user", "content": f"Summarize this chat from {topic_name}. Here are notes on it, in order:\n{notes}"}
+    ]
+    return await stream_completion(messages, on_text)
+
+def load_summary_checkpoint(chat_id, thread_id, window_minutes):
+    """Get the rolling /tldr summary saved for this topic and window length"""
+    def db_operation():
+        conn = storage.get_connection()
+        row = conn.execute("""SELECT window_start, covered_until, summary, mood, message_count FROM chat_context
+                              WHERE chat_id = ? AND thread_id = ? AND window_minutes = ?""",
+                           (int(chat_id), int(thread_id or 0), window_minutes)).fetchone()
+        if not row:
+            return None
+        return {"window_start": row[0], "covered_until": row[1], "summary": row[2], "mood": row[3], "message_count": row[4]}
+    
+    return safe_db_operation(db_operation)
+
+def save_summary_checkpoint(chat_id, thread_id, window_minutes, window_start, covered_until, summary, mood, message_count):
+    """Save the rolling /tldr summary for this topic and window length"""
+    def db_operation():
+        conn = storage.get_connection()
+        conn.execute("""INSERT INTO chat_context
+                            (chat_id, thread_id, window_minutes, window_start, covered_until, summary, mood, message_count, last_updated)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(chat_id, thread_id, window_minutes) DO UPDATE SET
+                            window_start = excluded.window_start,
+                            covered_until = excluded.covered_until,
+                            summary = excluded.summary,
+                            mood = excluded.mood,
+                            message_count = excluded.message_count,
+                            last_updated = excluded.last_updated""",
+                     (int(chat_id), int(thread_id or 0), window_minutes, window_start, covered_until,
+                      summary, mood, message_count, storage.now_ms()))
+        conn.commit()
+        return True
+    
+    return safe_db_operation(db_operation)
+
+async def update_rolling_summary(checkpoint, new_lines, topic_name, mood, on_text=None):
+    """Fold new messages into a saved summary with one request"""
+    messages = [
+        {"role": "system", "content": tldr_style_prompt(mood)},
+        {"role": "user", "content": f"Here's your summary of {topic_name} so far:\n{checkpoint['summary']}\n\n"
+                                    "New messages since then:\n" + "\n".join(new_lines) + "\n\n"
+                                    "Rewrite the summary so it covers everything, old and new."}
+    ]
+    return await stream_completion(messages, on_text)
+
+async def summarize_window(chat_id, thread_id, duration, recent_msgs, topic_name, mood, on_text=None):
+    """Summarize a topic's window, reusing its rolling checkpoint when possible
+    
+    If the saved checkpoint covers (about) the same window, only messages after it are summarized and merged in; with no new
+    messages the saved summary comes back as is.
+    """
+    cutoff = storage.now_ms() - duration * 60 * 1000
+    slack = max(5 * 60 * 1000, int(duration * 60 * 1000 * ROLLING_SUMMARY_SLACK))
+    checkpoint = await storage.run(load_summary_checkpoint, chat_id, thread_id, duration)
+    
+    summary = None
+    window_start = cutoff
+    if checkpoint and checkpoint["summary"] and checkpoint["mood"] == mood \
+            and abs(checkpoint["window_start"] - cutoff) <= slack:
+        new_lines = [f"{m.user}: {m.text}" for m in recent_msgs if storage.to_ms(m.timestamp) > checkpoint["covered_until"]]
+        if not new_lines:
+            logger.info(f"TLDR in {topic_name}: no new messages since checkpoint")
+            return checkpoint["summary"]
+        if sum(estimate_tokens(line) for line in new_lines) <= TLDR_CHUNK_TOKENS:
+            logger.info(f"TLDR in {topic_name}: merging {len(new_lines)} new messages into checkpoint")
+            summary = await update_rolling_summary(checkpoint, new_lines, topic_name, mood, on_text)
+            window_start = checkpoint["window_start"]
+    
+    if summary is None:
+        summary = await summarize_conversation([f"{m.user}: {m.text}" for m in recent_msgs], topic_name, mood, on_text)
+    
+    await storage.run(save_summary_checkpoint, chat_id, thread_id, duration, window_start,
+                      storage.to_ms(recent_msgs[-1].timestamp), summary, mood, len(recent_msgs))
+    return summary
 
 async def tldr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Summarize recent messages in current thread"""
@@ -779,7 +1744,7 @@ async def tldr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     thread_id = update.message.message_thread_id
     
     # Get messages from the current thread
-    recent_msgs = get_recent_messages(chat_id, thread_id, duration)
+    recent_msgs = await get_recent_messages(chat_id, thread_id, duration)
     
     # Debug info
     topic_name = "General" if not thread_id else "this topic"
@@ -811,23 +1776,30 @@ async def tldr(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # Build conversation
-    convo = "\n".join([f"{m['user']}: {m['text']}" for m in recent_msgs])
     mood = init_personality()
     
-    logger.info(f"Sending TLDR to OpenAI: {len(convo)} chars from {len(recent_msgs)} messages")
+    # Long windows fan out into many calls, so they queue behind replies and normal /tldrs
+    priority = scheduler.PRIORITY_BULK if duration > TLDR_BULK_MINUTES else scheduler.PRIORITY_TLDR
+    scheduler.set_job(priority, chat_id, user_id)
     
-    messages = [
-        {"role": "system", "content": f"You summarize Telegram group chats like a sassy friend. Keep it natural and conversational, not formal. You're {mood} today. No bullet points - just tell the story of what happened in this topic."},
-        {"role": "user", "content": f"Summarize this chat from {topic_name}:\n{convo}"}
-    ]
+    logger.info(f"Sending TLDR to OpenAI: ~{sum(estimate_tokens(m.text) for m in recent_msgs)} tokens "
+                f"from {len(recent_msgs)} messages")
     
-    reply = await safe_openai_call(messages)
+    streamed = StreamedReply(update.message) if STREAM_REPLIES else None
+    if streamed:
+        await streamed.start()
     
-    # Count toward daily usage
-    increment_daily_usage()
+    # Each request actually sent counts toward daily usage (see completion_with_retries)
+    try:
+        reply = await summarize_window(chat_id, thread_id, duration, recent_msgs, topic_name, mood,
+                                       on_text=streamed.update if streamed else None)
+    except Exception as e:
+        reply = friendly_openai_error(e)
     
-    await update.message.reply_text(reply)
+    if streamed:
+        await streamed.finish(reply)
+    else:
+        await update.message.reply_text(reply)
 
 async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Combined handler: store message AND check for AI replies"""
@@ -836,18 +1808,12 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not msg:
         return
         
-    # Create unique message ID to prevent double processing
-    msg_id = f"{msg.chat_id}_{msg.message_id}"
-    if msg_id in processed_messages:
+    # Skip messages we've already handled (e.g. updates redelivered after a restart)
+    if already_processed(msg):
         return
-    processed_messages.add(msg_id)
-    
-    # Periodic cleanup
-    if len(processed_messages) % 20 == 0:
-        cleanup_memory()
     
     # ALWAYS store the message first
-    store_message(update)
+    await store_message(update)
     
     # Analyze message for personal memories
     if msg.text and msg.from_user:
@@ -868,7 +1834,7 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             try:
                 await context.bot.send_message(chat_id=msg.chat_id, text=startup_message)
-                mark_startup_notified()
+                await storage.run(mark_startup_notified)
             except:
                 pass  # Don't crash if we can't send the notification
     
@@ -927,7 +1893,7 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = msg.from_user.id
     
     # Get user context
-    user_context = get_user_context(user_id)
+    user_context = await load_user_context(user_id)
     
     # Clean the prompt - remove @mentions
     prompt = text
@@ -948,20 +1914,21 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Show typing indicator
     await send_typing_action(update, context)
 
+    streamed = None
     try:
         mood = init_personality()
         
         # System prompt for AI responses
-        chat_context = get_recent_chat_context(msg.chat_id, limit=6)
-        context_info = f"Recent chat context:\n{chat_context}\n\n" if chat_context else ""
-        
-        # Build personal memory context
-        memory_context = ""
-        if user_context["memories"]:
-            memory_items = []
-            for memory in user_context["memories"]:
-                memory_items.append(f"- {memory['type']}: {memory['content']}")
-            memory_context = f"What you remember about {user_name}:\n" + "\n".join(memory_items) + "\n\n"
+        chat_context, (related_messages, related_memories) = await asyncio.gather(
+            load_recent_chat_context(msg.chat_id, msg.message_thread_id),
+            storage.run(retrieve_context, msg.chat_id, msg.message_thread_id, user_id, prompt)
+        )
+        recent_lines = set(chat_context)
+        related_lines = [f"{name} ({datetime.fromtimestamp(ts / 1000, timezone.utc):%b %d}): {text}"
+                         for name, text, ts in related_messages if f"{name}: {text}" not in recent_lines]
+        memories = user_context["memories"]
+        known = {m["content"] for m in memories}
+        memories = memories + [m for m in related_memories if m["content"] not in known]
         
         interaction_context = ""
         if user_context["interaction_count"] > 5:
@@ -969,11 +1936,20 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif user_context["interaction_count"] > 0:
             interaction_context = f"You've chatted with {user_name} a few times. "
         
-        system_prompt = f"""You are Summaria, the group's girly, shady zillenial bestie in the Tirz Girls chat. You're {mood} today. 
-
-{context_info}{memory_context}{interaction_context}
-
-Key vibes:
+        # Context sections are trimmed to fit PROMPT_TOKEN_BUDGET - old chat lines first, then the
+        # least weighty memories - while the persona and instructions always go in whole
+        builder = prompts.PromptBuilder(PROMPT_TOKEN_BUDGET)
+        builder.add("persona", f"You are Summaria, the group's girly, shady zillenial bestie in the Tirz Girls chat. "
+                               f"You're {mood} today.")
+        builder.add("related", lines=related_lines[:RETRIEVAL_TOP_K],
+                    header="Older messages from this chat that might be relevant:", importance=0,
+                    max_tokens=RETRIEVAL_MAX_TOKENS)
+        builder.add("chat_context", lines=chat_context, header="Recent chat context:", importance=1,
+                    max_tokens=CHAT_CONTEXT_MAX_TOKENS, keep="last")
+        builder.add("memories", lines=[f"- {m['type']}: {m['content']}" for m in memories],
+                    header=f"What you remember about {user_name}:", importance=2, max_tokens=MEMORY_MAX_TOKENS)
+        builder.add("interaction", interaction_context, importance=3)
+        builder.add("instructions", f"""Key vibes:
 - You're part of this friend group - chat about whatever they're talking about
 - Girly, sassy, but chill - not overly dramatic or constantly asking for tea
 - Zillenial energy: "no cap", "periodt", "it's giving...", "slay", "bestie", "babe" 
@@ -998,38 +1974,52 @@ IMPORTANT MEMORY INSTRUCTIONS:
 
 IMPORTANT: Act according to your current mood ({mood}). If you're "tired but observant", be more low-energy and brief. If you're "flirty and chaotic", be more playful and unpredictable. Let your mood actually affect your personality and response style.
 
-Be a normal friend who gives good responses without always asking for more info or trying to keep conversations going artificially."""
+Be a normal friend who gives good responses without always asking for more info or trying to keep conversations going artificially.""")
+        system_prompt, token_report = builder.build()
+        
+        # Very long messages are cut rather than failing on the context length
+        prompt = prompts.truncate_tokens(prompt, USER_PROMPT_MAX_TOKENS)
+        logger.info(f"Reply prompt tokens: {prompts.format_report(token_report)}, "
+                    f"message={estimate_tokens(prompt)}")
         
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": prompt}
         ]
         
-        reply = await safe_openai_call(messages)
+        # Usage is counted inside the call, and only when it reaches OpenAI
+        scheduler.set_job(scheduler.PRIORITY_MENTION, msg.chat_id, user_id)
+        if STREAM_REPLIES:
+            streamed = StreamedReply(msg)
+            await streamed.start()
+        reply = await safe_openai_call(messages, on_text=streamed.update if streamed else None)
         
         # Store bot's own message so it remembers what it said
-        store_bot_message(msg.chat_id, msg.message_thread_id, reply)
-        
-        # Increment usage AFTER successful API call
-        increment_daily_usage()
+        await store_bot_message(msg.chat_id, msg.message_thread_id, reply)
         
     except Exception as e:
         logger.error(f"Unexpected error in process_message: {e}")
         reply = "Something weird happened, try again? 🤔"
 
-    await msg.reply_text(reply)
+    if streamed:
+        await streamed.finish(reply)
+    else:
+        await msg.reply_text(reply)
 
 async def handle_image_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle messages with images - ONLY when specifically mentioned"""
     msg = update.message
     if not msg:
         return
+    
+    if already_processed(msg):
+        return
         
     # Store the message first if it has a caption
     if msg.caption:
         # Create a modified update to store the caption as text
         msg.text = msg.caption
-        store_message(update)
+        await store_message(update)
         
     # STRICT: Only analyze if explicitly mentioned or direct reply to bot
     text = (msg.caption or "").strip()
@@ -1049,8 +2039,8 @@ async def handle_image_message(update: Update, context: ContextTypes.DEFAULT_TYP
     
     user_id = msg.from_user.id
     
-    # Check daily limit with better messaging
-    if is_daily_limit_reached():
+    # Check daily limit with better messaging - images cost more than text
+    if is_daily_limit_reached(IMAGE_COST_MULTIPLIER):
         usage = get_daily_usage()
         await msg.reply_text(
             f"Hit my daily limit ({usage}/{DAILY_LIMIT}) 😴\n"
@@ -1075,7 +2065,7 @@ async def handle_image_message(update: Update, context: ContextTypes.DEFAULT_TYP
         file_url = file.file_path
         
         mood = init_personality()
-        user_context = get_user_context(msg.from_user.id)
+        user_context = await load_user_context(msg.from_user.id)
         
         # Clean the prompt
         prompt = text
@@ -1112,7 +2102,11 @@ Key vibes:
 
 Analyze what you see and respond helpfully in your casual style."""
 
-        completion = client.chat.completions.create(
+        # Usage is counted inside the call, and only when it reaches OpenAI
+        scheduler.set_job(scheduler.PRIORITY_IMAGE, msg.chat_id, user_id)
+        reply = await completion_with_retries(
+            cost=IMAGE_COST_MULTIPLIER,
+            use_cache=False,  # File URLs are one-off
             model="gpt-4o",  # GPT-4 Vision model
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -1126,11 +2120,11 @@ Analyze what you see and respond helpfully in your casual style."""
             ]
         )
         
-        reply = completion.choices[0].message.content.strip()
-        
-        # Increment usage after successful API call
-        increment_daily_usage()
-        
+    except scheduler.Rejected as e:
+        reply = friendly_openai_error(e)
+    except asyncio.TimeoutError:
+        logger.warning("Image analysis timed out")
+        reply = "OpenAI is being slow with image analysis, try again in a bit 🐌"
     except Exception as e:
         logger.error(f"Image analysis error: {e}")
         if "rate_limit" in str(e).lower():
@@ -1165,6 +2159,7 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     current_usage = get_daily_usage()
     remaining = DAILY_LIMIT - current_usage
     time_ago = get_time_since_startup()
+    queue = ai_scheduler.stats()
     
     if remaining > 100:
         energy_status = "lots of energy left!"
@@ -1177,6 +2172,7 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🤖 **Bot Status v{BOT_VERSION}**\n\n"
         f"💬 **Daily Usage:** {current_usage}/{DAILY_LIMIT} ({remaining} left)\n"
         f"⚡ **Energy:** {energy_status}\n"
+        f"🧠 **Thinking:** {queue['running']} now, {queue['queued']} waiting\n"
         f"🔄 **Last Restart:** {time_ago}\n\n"
         f"Note: I can only summarize messages from after my last restart!"
     )
@@ -1288,6 +2284,33 @@ async def convert_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         await update.message.reply_text("Invalid format! Try: /convert 5 mg mcg")
 
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Search this topic's history"""
+    if is_on_command_cooldown(update.effective_user.id):
+        return
+    
+    if not context.args:
+        await update.message.reply_text("Usage: /search [words] - e.g. /search dosing 7.5mg")
+        return
+    
+    text = " ".join(context.args)
+    thread_id = update.message.message_thread_id
+    topic_name = "General" if not thread_id else "this topic"
+    results = await storage.run(search_messages, update.effective_chat.id, thread_id, text)
+    
+    if results is None:
+        await update.message.reply_text("Search glitched, try different words? 🫠")
+        return
+    if not results:
+        await update.message.reply_text(f"Nothing about \"{text}\" in {topic_name} bestie 🔍")
+        return
+    
+    lines = [f"🔍 \"{text}\" in {topic_name}:\n"]
+    for user_name, timestamp, snippet in results:
+        day = datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime("%b %d")
+        lines.append(f"• {user_name}, {day}: {snippet}")
+    await update.message.reply_text("\n".join(lines))
+
 async def topic_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show current topic"""
     thread_id = update.message.message_thread_id
@@ -1317,7 +2340,7 @@ async def memories_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
     
-    memories = get_personal_memories(user_id, limit=15)
+    memories = await storage.run(get_personal_memories, user_id, limit=15)
     
     if not memories:
         await update.message.reply_text(f"I don't have any special memories about you yet {user_name}! Keep chatting with me and I'll remember the important stuff 💕")
@@ -1370,24 +2393,26 @@ async def forget_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        target_user_id = context.args[0]
+        target_user_id = int(context.args[0])
         
         def db_operation():
-            conn = sqlite3.connect(MEMORY_DB, timeout=30.0)
+            conn = storage.get_connection()
             cursor = conn.cursor()
             cursor.execute("DELETE FROM personal_memories WHERE user_id = ?", (target_user_id,))
             deleted_count = cursor.rowcount
             conn.commit()
-            conn.close()
             return deleted_count
         
-        deleted = safe_db_operation(db_operation)
+        deleted = await storage.run(safe_db_operation, db_operation)
+        user_contexts.invalidate(target_user_id)
         
         if deleted:
             await update.message.reply_text(f"Deleted {deleted} memories for user {target_user_id}")
         else:
             await update.message.reply_text(f"No memories found for user {target_user_id}")
             
+    except ValueError:
+        await update.message.reply_text("Usage: /forget [user_id] - user_id has to be a number")
     except Exception as e:
         await update.message.reply_text(f"Error: {e}")
 
@@ -1397,13 +2422,15 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     restart_note = ""
     
     # Only show restart info if recent
-    if get_startup_time() and (datetime.now(timezone.utc) - get_startup_time()).total_seconds() < 7200:
+    startup_time = get_startup_time()
+    if startup_time and (datetime.now(timezone.utc) - startup_time).total_seconds() < 7200:
         restart_note = f"\n💡 **Note:** I was restarted {time_ago}, so summaries only include messages from after that time."
     
     help_text = f"""🔮 **Summaria Commands v{BOT_VERSION}**
 
 📊 **Summarize:**
 /tldr [1h|3h|6h|all] - Summarize recent chat
+/search [words] - Find past messages in this topic
 
 💉 **Tirz Tools:**
 /recon [mg] [ml] - Reconstitution calculator 
@@ -1431,19 +2458,15 @@ async def resetmood(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Nice try bestie 💅")
         return
     
-    # Force reset personality by deleting the current one
-    conn = sqlite3.connect(MEMORY_DB)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM settings WHERE key = 'personality'")
-    conn.commit()
-    conn.close()
+    # Force reset personality by deleting the current one (this also drops it from the settings cache)
+    await storage.run(safe_db_operation, lambda: storage.settings.delete('personality'))
     
-    # Clear any cached personality and get new mood
-    new_mood = init_personality()
+    # Get new mood
+    new_mood = await storage.run(init_personality)
     
     # Also clear the bot's memory of its previous responses to ensure mood change takes effect
-    global chat_history
-    chat_history.clear()
+    for key in list(chat_history):
+        forget_history(key)
     
     await update.message.reply_text(f"🌀 Mood reset complete! New vibe: {new_mood}\n\nPersonality cache cleared - I'll respond with fresh energy!")
 
@@ -1465,13 +2488,119 @@ async def notify_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     await update.message.reply_text(restart_message)
-    mark_startup_notified()
+    await storage.run(mark_startup_notified)
+
+class StartupTimer:
+    """Seconds spent in each startup phase, in order"""
+    
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.phases = []  # (name, seconds)
+    
+    def mark(self, phase):
+        """End the phase that's been running since the previous mark"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+    
+    def elapsed(self):
+        return self.last - self.started
+    
+    def report(self, start=0):
+        return ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.phases[start:])
+
+startup_timer = StartupTimer(STARTUP_STARTED)
+startup_task = None  # after_ready, started by on_startup
+
+async def warm_up():
+    """Startup work that can wait until updates are flowing - each part can fail on its own"""
+    global vector_index
+    try:
+        # Imported off the event loop; the client itself is made on it, where it's used
+        await asyncio.to_thread(importlib.import_module, "openai")
+        get_openai_client()
+    except Exception as e:
+        logger.error(f"Couldn't warm up the OpenAI client: {e}")
+    startup_timer.mark("openai")
+    
+    try:
+        if await asyncio.to_thread(embeddings.available):
+            vector_index = await storage.run(open_vector_index)
+            background_tasks.append(asyncio.create_task(vector_sync_loop()))
+        else:
+            logger.info("numpy isn't installed, replies won't use the vector index")
+    except Exception as e:
+        logger.error(f"Couldn't open the vector index, replies won't use it: {e}")
+    startup_timer.mark("vector_index")
+    
+    try:
+        await asyncio.to_thread(prompts.load_encoding)
+    except Exception as e:
+        logger.error(f"Couldn't load the tokenizer: {e}")
+    startup_timer.mark("tokenizer")
+
+async def after_ready(app):
+    """Log how long it took to start taking updates, then warm up"""
+    while not app.running:  # PTB has no post-start hook; polling is already up once the app runs
+        await asyncio.sleep(0.05)
+    startup_timer.mark("telegram")
+    ready_after = startup_timer.elapsed()
+    ready_phases = len(startup_timer.phases)
+    logger.info(f"Ready for updates {ready_after:.2f}s after launch ({startup_timer.report()})")
+    
+    await warm_up()
+    logger.info(f"Warm-up took another {startup_timer.elapsed() - ready_after:.2f}s "
+                f"({startup_timer.report(ready_phases)})")
+
+async def on_startup(app):
+    """Start what handling updates needs, leaving the rest to after_ready"""
+    global startup_task
+    message_writer.start()
+    personal_memory_writer.start()
+    processed_writer.start()
+    background_tasks.append(asyncio.create_task(memory_cleanup_loop()))
+    background_tasks.append(asyncio.create_task(usage_checkpoint_loop()))
+    background_tasks.append(asyncio.create_task(retention_loop()))  # Waits RETENTION_START_DELAY first
+    startup_task = asyncio.create_task(after_ready(app))
+    background_tasks.append(startup_task)
+
+async def check_startup(app):
+    """--check-startup: start up to ready and through the warm-up, log the timing and stop
+    
+    Telegram is contacted (getMe) but never polled, so a running instance keeps its updates.
+    Returns the exit code.
+    """
+    ok = True
+    try:
+        await app.initialize()
+        await on_startup(app)
+        await app.start()
+        await startup_task
+    except Exception as e:
+        ok = False
+        logger.error(f"Startup check failed: {e}")
+    finally:
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await on_shutdown(app)
+    return 0 if ok else 1
+
+async def on_shutdown(app):
+    """Stop background tasks and run the graceful shutdown (covers SIGTERM in either mode)"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await message_writer.stop()
+    await personal_memory_writer.stop()
+    await processed_writer.stop()
+    graceful_shutdown()
 
 def main():
-    # Initialize database on startup
-    if not init_db():
-        logger.error("Failed to initialize database, exiting")
-        return
+    startup_timer.mark("imports")
+    check_mode = "--check-startup" in sys.argv[1:]
     
     if not TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN not found in environment variables")
@@ -1481,7 +2610,44 @@ def main():
         logger.error("OPENAI_API_KEY not found in environment variables")
         return
     
-    app = ApplicationBuilder().token(TOKEN).build()
+    if BOT_MODE not in ("polling", "webhook"):
+        logger.error(f"Unknown BOT_MODE '{BOT_MODE}', expected 'polling' or 'webhook'")
+        return
+    
+    # Initialize database on startup (migrations only run when the schema is behind)
+    if not init_db():
+        logger.error("Failed to initialize database, exiting")
+        return
+    startup_timer.mark("database")
+    daily_usage.load()
+    if DEDUP_PERSIST:
+        load_processed_messages()
+    startup_timer.mark("state")
+    
+    # Front router for multi-worker mode - the workers it starts run the rest of main()
+    if sharding.WORKERS > 1 and not sharding.is_worker() and not check_mode:
+        if BOT_MODE != "webhook":
+            logger.error("WORKERS > 1 needs BOT_MODE=webhook")
+            return
+        import webhook
+        from telegram import Bot
+        bot = Bot(TOKEN, base_url=TELEGRAM_BASE_URL) if TELEGRAM_BASE_URL else Bot(TOKEN)
+        logger.info(f"Starting Summaria v{BOT_VERSION} router...")
+        sharding.run(bot, host=webhook.WEBHOOK_HOST, port=webhook.WEBHOOK_PORT, path=webhook.WEBHOOK_PATH,
+                     url=webhook.WEBHOOK_URL, secret_token=webhook.WEBHOOK_SECRET)
+        return
+    
+    # Handle updates concurrently so one slow completion doesn't hold up every other chat
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    app = builder.build()
     
     # Command handlers
     app.add_handler(CommandHandler("tldr", tldr))
@@ -1493,6 +2659,7 @@ def main():
     app.add_handler(CommandHandler("storage", storage_cmd))
     app.add_handler(CommandHandler("convert", convert_cmd))
     app.add_handler(CommandHandler("topic", topic_cmd))
+    app.add_handler(CommandHandler("search", search_cmd))
     app.add_handler(CommandHandler("vibe", vibe_cmd))
     app.add_handler(CommandHandler("resetmood", resetmood))
     app.add_handler(CommandHandler("notifyrestart", notify_restart))
@@ -1506,14 +2673,19 @@ def main():
     # Handle text messages (this includes storing messages AND AI replies)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, process_message))
     
-    # Run monthly cleanup if needed
-    if should_run_cleanup():
-        logger.info("Running monthly data cleanup...")
-        cleanup_old_data()
-        mark_cleanup_done()
+    startup_timer.mark("app")
+    
+    if check_mode:
+        logger.info(f"Checking Summaria v{BOT_VERSION} startup...")
+        sys.exit(asyncio.run(check_startup(app)))
     
-    logger.info(f"Starting Summaria v{BOT_VERSION}...")
-    app.run_polling()
+    worker = f", worker {sharding.WORKER_INDEX}" if sharding.is_worker() else ""
+    logger.info(f"Starting Summaria v{BOT_VERSION} ({BOT_MODE}{worker})...")
+    if BOT_MODE == "webhook":
+        import webhook
+        webhook.run(app)
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
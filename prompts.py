@@ -0,0 +1,138 @@
+"""Token counting and budgeted prompt assembly
+
+count_tokens uses tiktoken once load_encoding() has run (main.py calls it off the
+event loop at startup), otherwise a ~4 characters per token estimate. The
+o200k_base encoding is fetched into tiktoken_cache/ at deploy time (entrypoint.sh).
+PromptBuilder fits a prompt's sections into a token budget by trimming the least
+important ones first.
+"""
+import logging
+import os
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")  # gpt-4o's encoding
+# tiktoken looks encodings up here (by the sha1 of their download URL) before fetching them
+TOKENIZER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache")
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def load_encoding():
+    """Load the tokenizer (a few hundred ms, so not on the event loop), returns it or None"""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None and tiktoken is not None:
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", TOKENIZER_CACHE_DIR)
+            try:
+                _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            except Exception as e:
+                logger.warning(f"Couldn't load tokenizer {TOKENIZER_ENCODING} ({e}), estimating tokens instead")
+    return _encoding
+
+
+def count_tokens(text):
+    """Tokens in text - exact once the tokenizer is loaded, else about 4 characters per token"""
+    encoding = _encoding
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def truncate_tokens(text, max_tokens):
+    """Cut text down to at most max_tokens, keeping the start"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _encoding
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max(0, (max_tokens - 1) * 4)]
+
+
+class Section:
+    """One part of a prompt
+
+    Sections made of lines lose whole lines when trimmed - from the front when
+    keep="last" (oldest chat messages go first), from the back when keep="first".
+    Sections with importance None are never trimmed.
+    """
+
+    def __init__(self, name, text="", lines=None, header="", importance=None, max_tokens=None, keep="first"):
+        self.name = name
+        self.text = text
+        self.lines = list(lines) if lines is not None else None
+        self.header = header
+        self.importance = importance
+        self.max_tokens = max_tokens
+        self.keep = keep
+        self.original_tokens = self.tokens()
+
+    def render(self):
+        if self.lines is None:
+            return self.text
+        if not self.lines:
+            return ""
+        body = "\n".join(self.lines)
+        return f"{self.header}\n{body}" if self.header else body
+
+    def tokens(self):
+        rendered = self.render()
+        return count_tokens(rendered) if rendered else 0
+
+    def trim_to(self, max_tokens):
+        """Shrink to fit max_tokens (a section that can't fit at all ends up empty)"""
+        if self.lines is None:
+            self.text = truncate_tokens(self.text, max_tokens) if max_tokens > 0 else ""
+            return
+        while self.lines and self.tokens() > max_tokens:
+            self.lines.pop(0 if self.keep == "last" else -1)
+
+
+class PromptBuilder:
+    """Assembles sections (in the order added) into one prompt of at most budget tokens"""
+
+    def __init__(self, budget, separator="\n\n"):
+        self.budget = budget
+        self.separator = separator
+        self.sections = []
+
+    def add(self, name, text="", **kwargs):
+        self.sections.append(Section(name, text, **kwargs))
+        return self
+
+    def build(self):
+        """Returns (prompt, report) where report maps section names to (tokens, tokens before trimming)"""
+        for section in self.sections:
+            if section.max_tokens is not None and section.importance is not None \
+                    and section.tokens() > section.max_tokens:
+                section.trim_to(section.max_tokens)
+
+        # Least important first; the separators count toward the budget too
+        overhead = count_tokens(self.separator) * max(0, len(self.sections) - 1)
+        total = sum(section.tokens() for section in self.sections) + overhead
+        trimmable = sorted((s for s in self.sections if s.importance is not None), key=lambda s: s.importance)
+        for section in trimmable:
+            if total <= self.budget:
+                break
+            before = section.tokens()
+            section.trim_to(max(0, before - (total - self.budget)))
+            total -= before - section.tokens()
+
+        prompt = self.separator.join(rendered for rendered in (s.render() for s in self.sections) if rendered)
+        report = {s.name: (s.tokens(), s.original_tokens) for s in self.sections}
+        return prompt, report
+
+
+def format_report(report):
+    """'name=tokens' pairs for logging, noting what was trimmed"""
+    parts = []
+    for name, (tokens, original) in report.items():
+        parts.append(f"{name}={tokens}" if tokens == original else f"{name}={tokens}/{original}")
+    return ", ".join(parts)
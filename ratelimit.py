@@ -0,0 +1,125 @@
+"""Client-side pacing for OpenAI - request and token buckets kept in step with x-ratelimit-* headers
+
+Every completion takes one request and its estimated tokens from the buckets
+before it's sent, waiting if either is short. Both buckets refill continuously at
+the per-minute limit, and each response's headers bring them back in line with
+what OpenAI says is left (and how long until it resets), so calls slow down
+before they start getting 429s instead of after.
+"""
+import asyncio
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))  # Requests per minute until headers say otherwise
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "30000"))  # Tokens per minute until headers say otherwise
+RATE_LIMIT_DEFAULT_PAUSE = 1.0  # Seconds to hold off after a 429 that doesn't say for how long
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT_SECONDS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+
+def parse_reset(value):
+    """Seconds in a reset header like '1s', '6m0s' or '20ms' (None if it can't be read)"""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _UNIT_SECONDS[unit] for amount, unit in parts)
+
+
+def _int_header(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Bucket refilled at capacity per minute, which can be re-synced from the server's view"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.capacity / 60.0
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount is available (a request bigger than the bucket waits for a full one)"""
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def sync(self, limit, remaining, now):
+        """Adopt the server's limit and, if it's lower than ours, its remaining count"""
+        self.refill(now)
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """Request and token buckets shared by every OpenAI call"""
+
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        """Wait until one request and this many tokens are available, then take them"""
+        async with self._lock:  # First come first served - the scheduler already picked the order
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = max(self._paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    self.requests.level -= 1
+                    self.tokens.level -= tokens
+                    return
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated, actual):
+        """Correct the token bucket once a response says how many tokens were really used"""
+        if actual is not None:
+            self.tokens.level -= actual - estimated
+
+    def update_from_headers(self, headers):
+        """Line the buckets up with a response's x-ratelimit-* headers"""
+        now = time.monotonic()
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = _int_header(headers, f"x-ratelimit-limit-{kind}")
+            remaining = _int_header(headers, f"x-ratelimit-remaining-{kind}")
+            bucket.sync(limit, remaining, now)
+            if remaining == 0:
+                reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                if reset:
+                    self._paused_until = max(self._paused_until, now + reset)
+
+    def rate_limited(self, headers=None):
+        """Hold every call back after a 429, for as long as the response asks"""
+        headers = headers or {}
+        retry_after_ms = parse_reset(headers.get("retry-after-ms"))
+        pause = retry_after_ms / 1000 if retry_after_ms is not None else parse_reset(headers.get("retry-after"))
+        if pause is None:
+            resets = [parse_reset(headers.get(f"x-ratelimit-reset-{kind}")) for kind in ("requests", "tokens")]
+            pause = max([r for r in resets if r] or [RATE_LIMIT_DEFAULT_PAUSE])
+        logger.warning(f"OpenAI rate limit hit, pausing calls for {pause:.1f}s")
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        self.update_from_headers(headers)
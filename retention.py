@@ -0,0 +1,135 @@
+"""Background retention - expired rows deleted in small batches, freed pages handed back to the OS
+
+Each Rule names a table and the condition its expired rows match. A pass walks
+the rules and deletes up to RETENTION_BATCH_SIZE rows per transaction (picked
+through the index on the rule's column), yielding between batches so replies and
+the write-behind queues never wait long for the write lock. Once the deletes are
+done the database's free pages are released with PRAGMA incremental_vacuum, a
+chunk at a time (auto_vacuum is switched to INCREMENTAL by migration 11).
+
+run_pass returns what it removed and how many bytes the file shrank by.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))  # Seconds between retention passes
+RETENTION_START_DELAY = 120  # Seconds after startup before the first pass
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))  # Rows deleted per transaction
+RETENTION_BATCH_PAUSE = 0.05  # Seconds between batches, so other writers get the lock
+RETENTION_VACUUM_PAGES = 1000  # Pages released per incremental_vacuum step
+
+
+class Rule:
+    """Rows of table matching `where`, which takes the value cutoff() returns at the start of a pass
+
+    key selects the rows to delete - rowid, or the primary key columns of a WITHOUT ROWID table.
+    """
+
+    def __init__(self, name, table, where, cutoff, key="rowid"):
+        self.name = name
+        self.table = table
+        self.where = where
+        self.cutoff = cutoff
+        self.key = key
+
+    def delete_sql(self):
+        return (f"DELETE FROM {self.table} WHERE ({self.key}) IN "
+                f"(SELECT {self.key} FROM {self.table} WHERE {self.where} LIMIT ?)")
+
+
+def delete_batch(rule, cutoff, batch_size=RETENTION_BATCH_SIZE):
+    """Delete up to batch_size expired rows in one transaction, returns how many"""
+    conn = storage.get_connection()
+    try:
+        deleted = conn.execute(rule.delete_sql(), (cutoff, batch_size)).rowcount
+        conn.commit()
+        return deleted
+    except Exception:
+        storage.rollback()
+        raise
+
+
+def page_stats():
+    """(page_count, freelist_count, page_size) of the database"""
+    conn = storage.get_connection()
+    return tuple(conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+                 for pragma in ("page_count", "freelist_count", "page_size"))
+
+
+def vacuum_step(max_pages=RETENTION_VACUUM_PAGES):
+    """Release up to max_pages free pages, returns how many are still free"""
+    conn = storage.get_connection()
+    # executescript steps the pragma to completion; execute() would free a single page
+    conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def checkpoint():
+    """Copy the WAL back into the database file, which is when a vacuumed file actually shrinks"""
+    # PASSIVE never waits on readers; pages it can't copy now go in a later checkpoint
+    storage.get_connection().execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+
+
+def auto_vacuum_mode():
+    return storage.get_connection().execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+async def run_pass(rules, batch_size=RETENTION_BATCH_SIZE, pause=RETENTION_BATCH_PAUSE):
+    """Apply every rule, then release the freed pages
+
+    Returns {"rows": {rule name: rows deleted}, "reclaimed_bytes", "size_bytes", "free_bytes", "seconds"}.
+    """
+    started = time.monotonic()
+    pages_before, _, page_size = await storage.run(page_stats)
+    rows = {}
+    for rule in rules:
+        cutoff = rule.cutoff()
+        deleted = 0
+        while True:
+            batch = await storage.run(delete_batch, rule, cutoff, batch_size)
+            deleted += batch
+            if batch < batch_size:
+                break
+            await asyncio.sleep(pause)
+        rows[rule.name] = rows.get(rule.name, 0) + deleted
+
+    # Without incremental auto_vacuum the free pages just get reused by later writes
+    if await storage.run(auto_vacuum_mode) == 2:
+        free = None
+        while True:
+            remaining = await storage.run(vacuum_step)
+            if not remaining or remaining == free:
+                break
+            free = remaining
+            await asyncio.sleep(pause)
+        await storage.run(checkpoint)
+    pages_after, free_pages, _ = await storage.run(page_stats)
+    return {
+        "rows": rows,
+        "reclaimed_bytes": (pages_before - pages_after) * page_size,
+        "size_bytes": pages_after * page_size,
+        "free_bytes": free_pages * page_size,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def format_report(report):
+    """One-line summary of a pass for the log"""
+    deleted = ", ".join(f"{name}={count}" for name, count in report["rows"].items() if count) or "nothing"
+    return (f"deleted {deleted}; reclaimed {format_bytes(report['reclaimed_bytes'])}, "
+            f"database now {format_bytes(report['size_bytes'])} "
+            f"({format_bytes(report['free_bytes'])} free) in {report['seconds']:g}s")
@@ -0,0 +1,178 @@
+"""Fair scheduling of AI jobs - priority classes, per-chat/per-user fair queuing, admission control
+
+Every completion asks the scheduler for one of a fixed number of slots before it
+goes to OpenAI. Waiting jobs are ordered first by priority class, then by a
+virtual finish time (start-time fair queuing): each job's tag is pushed past the
+latest tag already given to its chat and to its user, by its cost. A chat or user
+with a lot queued therefore waits behind everyone else's first job instead of
+holding every slot.
+
+Jobs are turned away (Rejected) rather than queued when:
+- the queue, or the chat's share of it, is full - lower classes hit a smaller cap
+- the daily budget couldn't cover it once everything already admitted is paid for,
+  with a reserve kept back for direct replies
+- they waited longer than max_wait for a slot
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+from collections import Counter
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first
+PRIORITY_MENTION = 0  # Direct mentions and replies to the bot
+PRIORITY_IMAGE = 1  # Image analysis
+PRIORITY_TLDR = 2  # /tldr over a normal window
+PRIORITY_BULK = 3  # Long /tldr windows (several map-reduce calls)
+
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "64"))  # Jobs waiting for a slot, all chats
+SCHEDULER_MAX_PER_CHAT = int(os.getenv("SCHEDULER_MAX_PER_CHAT", "16"))  # Jobs waiting from one chat
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", "45"))  # Seconds a job may wait for a slot
+SCHEDULER_RESERVE = float(os.getenv("SCHEDULER_RESERVE", "0.05"))  # Share of the daily budget kept for mentions
+
+# Share of SCHEDULER_MAX_QUEUE each class may fill, so the bulky ones back off first
+QUEUE_SHARE = {PRIORITY_MENTION: 1.0, PRIORITY_IMAGE: 0.75, PRIORITY_TLDR: 0.5, PRIORITY_BULK: 0.25}
+
+# (priority, chat_id, user_id) of the job the current task is working for
+current_job = contextvars.ContextVar("current_job", default=(PRIORITY_TLDR, 0, 0))
+
+
+def set_job(priority, chat_id, user_id):
+    """Tag AI calls made from this task (and tasks it starts) with a class, chat and user"""
+    current_job.set((priority, chat_id, user_id))
+
+
+class Rejected(Exception):
+    """The scheduler turned a job away instead of queueing it"""
+
+    def __init__(self, reason):
+        super().__init__(f"scheduler rejected job: {reason}")
+        self.reason = reason  # "queue_full", "budget" or "wait_timeout"
+
+
+class _Job:
+    __slots__ = ("priority", "finish", "seq", "chat_id", "cost", "future")
+
+    def __init__(self, priority, finish, seq, chat_id, cost, future):
+        self.priority = priority
+        self.finish = finish
+        self.seq = seq
+        self.chat_id = chat_id
+        self.cost = cost
+        self.future = future
+
+    def __lt__(self, other):
+        return (self.priority, self.finish, self.seq) < (other.priority, other.finish, other.seq)
+
+
+class FairScheduler:
+    """Hands out a fixed number of concurrent AI slots fairly across chats and users
+
+    budget_left is a callable returning how much of today's budget is unused; it's
+    read at admission time, together with the cost of jobs already admitted.
+    """
+
+    def __init__(self, slots, budget_left=None, daily_limit=None, max_queue=SCHEDULER_MAX_QUEUE,
+                 max_per_chat=SCHEDULER_MAX_PER_CHAT, max_wait=SCHEDULER_MAX_WAIT, reserve=SCHEDULER_RESERVE):
+        self.slots = slots
+        self.budget_left = budget_left
+        self.reserve = int((daily_limit or 0) * reserve)
+        self.max_queue = max_queue
+        self.max_per_chat = max_per_chat
+        self.max_wait = max_wait
+        self._heap = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._queued = 0
+        self._queued_per_chat = Counter()
+        self._reserved = 0  # Cost of admitted jobs that haven't finished
+        self._vtime = 0.0
+        self._chat_finish = {}
+        self._user_finish = {}
+
+    def stats(self):
+        return {"running": self._running, "queued": self._queued, "reserved": self._reserved}
+
+    def _admit(self, priority, chat_id, cost):
+        if self._queued >= self.max_queue * QUEUE_SHARE.get(priority, 0.25) \
+                or self._queued_per_chat[chat_id] >= self.max_per_chat:
+            raise Rejected("queue_full")
+        if self.budget_left is not None:
+            floor = 0 if priority == PRIORITY_MENTION else self.reserve
+            if self.budget_left() - self._reserved - cost < floor:
+                raise Rejected("budget")
+
+    def _finish_tag(self, chat_id, user_id, cost):
+        start = max(self._vtime, self._chat_finish.get(chat_id, 0.0), self._user_finish.get(user_id, 0.0))
+        finish = start + cost
+        self._chat_finish[chat_id] = finish
+        self._user_finish[user_id] = finish
+        return finish
+
+    def _dispatch(self):
+        """Start queued jobs while there are free slots"""
+        while self._heap and self._running < self.slots:
+            job = heapq.heappop(self._heap)
+            if job.future.done():
+                continue  # Gave up waiting, already taken off the counts
+            self._queued -= 1
+            self._queued_per_chat[job.chat_id] -= 1
+            if not self._queued_per_chat[job.chat_id]:
+                del self._queued_per_chat[job.chat_id]
+            self._running += 1
+            self._vtime = max(self._vtime, job.finish - job.cost)
+            job.future.set_result(None)
+        if not self._heap and len(self._chat_finish) > 1000:
+            # Tags at or behind the virtual clock don't change anything any more
+            self._chat_finish = {k: v for k, v in self._chat_finish.items() if v > self._vtime}
+            self._user_finish = {k: v for k, v in self._user_finish.items() if v > self._vtime}
+
+    @asynccontextmanager
+    async def slot(self, cost=1):
+        """Wait for a slot for the current job (see set_job), raising Rejected if it can't have one"""
+        priority, chat_id, user_id = current_job.get()
+        self._admit(priority, chat_id, cost)
+        self._reserved += cost
+        try:
+            job = _Job(priority, self._finish_tag(chat_id, user_id, cost), next(self._seq), chat_id, cost,
+                       asyncio.get_running_loop().create_future())
+            heapq.heappush(self._heap, job)
+            self._queued += 1
+            self._queued_per_chat[chat_id] += 1
+            self._dispatch()
+            try:
+                await asyncio.wait_for(job.future, self.max_wait)
+            except asyncio.TimeoutError:
+                self._forget(job)
+                logger.warning(f"AI job for chat {chat_id} waited over {self.max_wait:g}s, dropping it")
+                raise Rejected("wait_timeout")
+            except asyncio.CancelledError:
+                if job.future.cancelled():
+                    self._forget(job)
+                else:
+                    self._release()  # The slot was handed over just as the task got cancelled
+                raise
+        except BaseException:
+            self._reserved -= cost
+            raise
+        try:
+            yield
+        finally:
+            self._reserved -= cost
+            self._release()
+
+    def _forget(self, job):
+        """Take a job that stopped waiting off the queue counts (it stays in the heap, skipped)"""
+        self._queued -= 1
+        self._queued_per_chat[job.chat_id] -= 1
+        if not self._queued_per_chat[job.chat_id]:
+            del self._queued_per_chat[job.chat_id]
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
@@ -0,0 +1,234 @@
+"""Multi-worker mode - a front router sharding updates across bot processes by chat
+
+With WORKERS > 1 (webhook mode only) main.py starts this router instead of a bot.
+It receives Telegram's webhook calls and forwards each update to one of WORKERS
+child processes, each a normal webhook-mode bot on a local port. The worker is
+picked by a consistent hash of the chat id, so a chat's history, cooldowns and
+dedup state live in a single process and its updates arrive there in order.
+Workers share the SQLite database; the daily usage counter is coordinated through
+its UPSERT checkpoints (see UsageCounter).
+
+aiohttp is imported where the router needs it, so polling-mode bots (which only
+use the helpers at the top) don't pay for it at startup.
+"""
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import subprocess
+import sys
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("WORKERS", "1"))  # Bot processes to shard chats across (1 = no router)
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8100"))  # Worker i listens on base + i
+WORKER_INDEX = os.getenv("WORKER_INDEX")  # Set by the router for the processes it starts
+HASH_REPLICAS = 64  # Points per worker on the hash ring
+FORWARD_RETRY_MAX = 5.0  # Longest wait between attempts while a worker is down
+DRAIN_TIMEOUT = 10  # Seconds to finish forwarding queued updates on shutdown
+
+_ring = None
+
+
+def is_worker():
+    """True when this process was started by the router"""
+    return WORKER_INDEX is not None
+
+
+def is_primary():
+    """True for the one process that should run once-per-deployment jobs"""
+    return WORKER_INDEX in (None, "0")
+
+
+def owns_chat(chat_id):
+    """True if this process handles the chat (always, outside multi-worker mode)"""
+    global _ring
+    if not is_worker():
+        return True
+    if _ring is None:
+        _ring = HashRing(range(WORKERS))
+    return _ring.node_for(chat_id) == int(WORKER_INDEX)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring, so changing the worker count only moves a share of the chats"""
+
+    def __init__(self, nodes, replicas=HASH_REPLICAS):
+        points = sorted((_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+def update_chat_id(data):
+    """Chat id of a raw update (the sender for updates without a chat), 0 if there's neither"""
+    for field, value in data.items():
+        if field == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id", 0)
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender.get("id", 0)
+    return 0
+
+
+class WorkerLink:
+    """Forwards updates to one worker in arrival order, holding them while it's down"""
+
+    def __init__(self, index, port, secret_token):
+        self.index = index
+        self.url = f"http://127.0.0.1:{port}/telegram"
+        self.secret_token = secret_token
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    def start(self, session):
+        self._task = asyncio.create_task(self._forward_loop(session))
+
+    async def _forward_loop(self, session):
+        import aiohttp
+        while True:
+            body = await self.queue.get()
+            delay = 0.2
+            while True:
+                try:
+                    async with session.post(self.url, data=body,
+                                            headers={"Content-Type": "application/json",
+                                                     "X-Telegram-Bot-Api-Secret-Token": self.secret_token}) as resp:
+                        if resp.status >= 500:
+                            raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                        if resp.status != 200:
+                            logger.error(f"Worker {self.index} rejected an update ({resp.status}), dropping it")
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning(f"Worker {self.index} unreachable ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, FORWARD_RETRY_MAX)
+            self.queue.task_done()
+
+    async def stop(self):
+        try:
+            await asyncio.wait_for(self.queue.join(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.queue.qsize()} updates queued for worker {self.index}")
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def spawn_worker(index, port, secret_token):
+    """Start worker `index` as a webhook-mode bot on a local port"""
+    env = dict(os.environ,
+               BOT_MODE="webhook",
+               WORKER_INDEX=str(index),
+               WEBHOOK_HOST="127.0.0.1",
+               WEBHOOK_PORT=str(port),
+               WEBHOOK_PATH="/telegram",
+               WEBHOOK_URL="",  # Only the router registers with Telegram
+               WEBHOOK_SECRET=secret_token)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    return subprocess.Popen([sys.executable, script], env=env)
+
+
+def make_router_app(ring, links, secret_token=None, path="/telegram"):
+    """aiohttp app that routes each POSTed update to its chat's worker"""
+    from aiohttp import web
+
+    async def handle_update(request):
+        if secret_token and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""),
+                                                    secret_token):
+            logger.warning(f"Rejected webhook call from {request.remote}: bad secret token")
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            data = json.loads(body)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        links[ring.node_for(update_chat_id(data))].queue.put_nowait(body)
+        return web.Response()
+
+    async def handle_health(request):
+        return web.Response(text="ok")
+
+    web_app = web.Application()
+    web_app.router.add_post(path, handle_update)
+    web_app.router.add_get("/healthz", handle_health)
+    return web_app
+
+
+async def serve_router(bot, workers=WORKERS, host="0.0.0.0", port=8080, path="/telegram", url=None,
+                       secret_token=None, base_port=WORKER_BASE_PORT, stop_event=None):
+    """Start the workers and route updates to them until SIGINT/SIGTERM (or stop_event)"""
+    import aiohttp
+    from aiohttp import web
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    internal_secret = secrets.token_urlsafe(32)
+    links = [WorkerLink(i, base_port + i, internal_secret) for i in range(workers)]
+    ring = HashRing(range(workers))
+    processes = [spawn_worker(i, base_port + i, internal_secret) for i in range(workers)]
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(1)
+            for i, proc in enumerate(processes):
+                if proc.poll() is not None:
+                    logger.error(f"Worker {i} exited with {proc.returncode}, restarting it")
+                    processes[i] = spawn_worker(i, base_port + i, internal_secret)
+
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+    for link in links:
+        link.start(session)
+    supervisor = asyncio.create_task(supervise())
+    runner = web.AppRunner(make_router_app(ring, links, secret_token, path))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        if url:
+            async with bot:
+                await bot.set_webhook(url=url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Router listening on {host}:{port}{path}, sharding across {workers} workers")
+        await stop_event.wait()
+    finally:
+        logger.info("Stopping router...")
+        await runner.cleanup()
+        supervisor.cancel()
+        await asyncio.gather(supervisor, return_exceptions=True)
+        await asyncio.gather(*(link.stop() for link in links))
+        await session.close()
+        for proc in processes:
+            proc.terminate()
+        for proc in processes:
+            try:
+                await asyncio.wait_for(loop.run_in_executor(None, proc.wait), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                proc.kill()
+
+
+def run(bot, **kwargs):
+    """Blocking entry point for the router"""
+    asyncio.run(serve_router(bot, **kwargs))
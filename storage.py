@@ -0,0 +1,532 @@
+"""SQLite storage layer - long-lived tuned connections shared by every DB helper"""
+import os
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+MEMORY_DB = os.getenv("MEMORY_DB", "memory.sqlite")
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))  # Threads (and connections) serving async handlers
+STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection
+BOT_USER_ID = 0  # user_id stored for the bot's own messages (Telegram ids are positive)
+
+# Applied to every new connection. WAL lets readers run while a write is in progress,
+# and synchronous=NORMAL is safe under WAL while skipping an fsync per commit.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",  # ~16MB page cache
+    "PRAGMA mmap_size=134217728",  # 128MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA journal_size_limit=67108864",  # Truncate the WAL back to 64MB after checkpoints
+)
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_executor = None
+
+
+def now_ms():
+    """Current UTC time as epoch milliseconds, the on-disk timestamp format"""
+    return int(time.time() * 1000)
+
+
+def to_ms(seconds):
+    """Epoch seconds (float) to epoch milliseconds, rounding the same way in both directions"""
+    return int(round(seconds * 1000))
+
+
+def content_hash(text):
+    """Stable hash of text, ignoring case and whitespace differences"""
+    normalized = " ".join(text.lower().split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def connect(path=None):
+    """Open a new connection with the tuned pragmas applied"""
+    conn = sqlite3.connect(
+        path or MEMORY_DB,
+        timeout=30.0,
+        check_same_thread=False,  # Only ever used by the thread that opened it, closed from close_all
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection():
+    """Get this thread's long-lived connection, opening it on first use"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = connect()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def rollback():
+    """Roll back an unfinished transaction left on this thread's connection"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and conn.in_transaction:
+        try:
+            conn.rollback()
+        except sqlite3.Error as e:
+            logger.error(f"Rollback failed: {e}")
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="summaria-db")
+    return _executor
+
+
+async def run(func, *args, **kwargs):
+    """Run a blocking DB helper on the storage threads so the event loop keeps going"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), partial(func, *args, **kwargs))
+
+
+class SettingsCache:
+    """Process-wide copy of the settings table
+
+    Loaded once at startup; set() and delete() write through to the database and
+    update the copy, so reads never touch disk.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._lock = threading.Lock()
+
+    def load(self, conn=None):
+        conn = conn or get_connection()
+        values = dict(conn.execute("SELECT key, value FROM settings").fetchall())
+        with self._lock:
+            self._values = values
+
+    def invalidate(self):
+        """Drop the copy so the next read loads it again"""
+        with self._lock:
+            self._values = None
+
+    def get(self, key, default=None):
+        if self._values is None:
+            self.load()
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        conn = get_connection()
+        conn.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        conn.commit()
+        with self._lock:
+            if self._values is not None:
+                self._values[key] = value
+        return True
+
+    def delete(self, key):
+        conn = get_connection()
+        conn.execute("DELETE FROM settings WHERE key = ?", (key,))
+        conn.commit()
+        with self._lock:
+            if self._values is not None:
+                self._values.pop(key, None)
+        return True
+
+
+settings = SettingsCache()
+
+
+class WriteBehindQueue:
+    """Buffers rows in memory and hands them to write_batch in one go
+
+    write_batch runs on a storage thread with the list of queued items and should
+    write them in a single transaction, returning a falsy value if it failed so
+    the items are queued again. Batches go out when batch_size items are waiting
+    or every flush_interval seconds, whichever comes first.
+    """
+
+    def __init__(self, write_batch, batch_size=100, flush_interval=2.0, max_pending=10000):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._items = []
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        with self._lock:
+            self._items.append(item)
+            pending = len(self._items)
+        if pending >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write everything queued so far on the calling thread, returns rows written"""
+        with self._lock:
+            items, self._items = self._items, []
+        if not items:
+            return 0
+
+        if not self.write_batch(items):
+            with self._lock:
+                # Put them back in front of anything queued meanwhile, but don't grow forever
+                self._items[:0] = items
+                dropped = len(self._items) - self.max_pending
+                if dropped > 0:
+                    del self._items[:dropped]
+                    logger.error(f"Write queue full, dropped {dropped} oldest rows")
+            return 0
+        return len(items)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await run(self.flush)
+            except Exception as e:
+                logger.error(f"Background flush failed: {e}")
+
+    def start(self):
+        """Start the background flusher on the running event loop"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background flusher and write whatever is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        await run(self.flush)
+
+
+def _create_base_tables(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS nicknames (user_id TEXT PRIMARY KEY, name TEXT)")
+
+    # Original memory schema - thread_id is added by the next migration
+    cursor.execute("""CREATE TABLE IF NOT EXISTS memory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT,
+        user_id TEXT,
+        user_name TEXT,
+        message TEXT,
+        timestamp TEXT
+    )""")
+
+    cursor.execute("""CREATE TABLE IF NOT EXISTS user_preferences (
+        user_id TEXT PRIMARY KEY,
+        nickname TEXT,
+        personality_notes TEXT,
+        last_interaction TEXT,
+        interaction_count INTEGER DEFAULT 0
+    )""")
+
+    # Personal memory table for deeper relationships
+    cursor.execute("""CREATE TABLE IF NOT EXISTS personal_memories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        user_name TEXT,
+        memory_type TEXT,
+        memory_content TEXT,
+        emotional_weight INTEGER DEFAULT 1,
+        timestamp TEXT,
+        chat_id TEXT
+    )""")
+
+    cursor.execute("""CREATE TABLE IF NOT EXISTS chat_context (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT,
+        thread_id TEXT,
+        topic TEXT,
+        last_updated TEXT,
+        message_count INTEGER DEFAULT 0
+    )""")
+
+
+def _add_memory_thread_id(cursor):
+    # Databases created before versioning may already have the column
+    cursor.execute("PRAGMA table_info(memory)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'thread_id' not in columns:
+        cursor.execute("ALTER TABLE memory ADD COLUMN thread_id TEXT DEFAULT '0'")
+    cursor.execute("UPDATE memory SET thread_id = '0' WHERE thread_id IS NULL")
+
+
+def _add_lookup_indexes(cursor):
+    # get_recent_messages: one topic, time range
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_memory_chat_thread_ts ON memory (chat_id, thread_id, timestamp)")
+    # get_recent_chat_context: newest messages in a chat
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_memory_chat_ts ON memory (chat_id, timestamp)")
+    # Retention deletes by age
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_memory_ts ON memory (timestamp)")
+    # get_personal_memories: ORDER BY emotional_weight DESC, timestamp DESC per user
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_personal_memories_user_weight_ts "
+                   "ON personal_memories (user_id, emotional_weight, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_personal_memories_ts ON personal_memories (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_preferences_last_interaction "
+                   "ON user_preferences (last_interaction)")
+    cursor.execute("ANALYZE")
+
+
+# ISO-8601 text (as written by datetime.isoformat) -> epoch milliseconds
+def _iso_to_ms(column):
+    return f"COALESCE(CAST((julianday({column}) - 2440587.5) * 86400000 AS INTEGER), 0)"
+
+
+def _use_integer_columns(cursor):
+    # Rebuild each table with INTEGER ids and epoch-millis timestamps, copying rows
+    # across with a single INSERT ... SELECT per table. 'bot' user ids become BOT_USER_ID.
+    cursor.execute("""CREATE TABLE memory_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        thread_id INTEGER NOT NULL DEFAULT 0,
+        user_id INTEGER,
+        user_name TEXT,
+        message TEXT,
+        timestamp INTEGER NOT NULL
+    )""")
+    cursor.execute(f"""INSERT INTO memory_new (id, chat_id, thread_id, user_id, user_name, message, timestamp)
+                       SELECT id, CAST(chat_id AS INTEGER), CAST(COALESCE(thread_id, 0) AS INTEGER),
+                              CAST(user_id AS INTEGER), user_name, message, {_iso_to_ms('timestamp')}
+                       FROM memory""")
+
+    cursor.execute("""CREATE TABLE personal_memories_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        user_name TEXT,
+        memory_type TEXT,
+        memory_content TEXT,
+        emotional_weight INTEGER DEFAULT 1,
+        timestamp INTEGER NOT NULL,
+        chat_id INTEGER
+    )""")
+    cursor.execute(f"""INSERT INTO personal_memories_new
+                           (id, user_id, user_name, memory_type, memory_content, emotional_weight, timestamp, chat_id)
+                       SELECT id, CAST(user_id AS INTEGER), user_name, memory_type, memory_content,
+                              emotional_weight, {_iso_to_ms('timestamp')}, NULLIF(CAST(chat_id AS INTEGER), 0)
+                       FROM personal_memories""")
+
+    cursor.execute("""CREATE TABLE user_preferences_new (
+        user_id INTEGER PRIMARY KEY,
+        nickname TEXT,
+        personality_notes TEXT,
+        last_interaction INTEGER,
+        interaction_count INTEGER DEFAULT 0
+    )""")
+    cursor.execute(f"""INSERT OR REPLACE INTO user_preferences_new
+                           (user_id, nickname, personality_notes, last_interaction, interaction_count)
+                       SELECT CAST(user_id AS INTEGER), nickname, personality_notes,
+                              {_iso_to_ms('last_interaction')}, interaction_count
+                       FROM user_preferences""")
+
+    cursor.execute("CREATE TABLE nicknames_new (user_id INTEGER PRIMARY KEY, name TEXT)")
+    cursor.execute("""INSERT OR REPLACE INTO nicknames_new (user_id, name)
+                      SELECT CAST(user_id AS INTEGER), name FROM nicknames""")
+
+    cursor.execute("""CREATE TABLE chat_context_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        thread_id INTEGER,
+        topic TEXT,
+        last_updated INTEGER,
+        message_count INTEGER DEFAULT 0
+    )""")
+    cursor.execute(f"""INSERT INTO chat_context_new (id, chat_id, thread_id, topic, last_updated, message_count)
+                       SELECT id, CAST(chat_id AS INTEGER), CAST(COALESCE(thread_id, 0) AS INTEGER), topic,
+                              {_iso_to_ms('last_updated')}, message_count
+                       FROM chat_context""")
+
+    for table in ("memory", "personal_memories", "user_preferences", "nicknames", "chat_context"):
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    # Dropping the old tables dropped their indexes too
+    _add_lookup_indexes(cursor)
+    return True  # Old TEXT pages are now free - reclaim them
+
+
+def _add_daily_usage_table(cursor):
+    # Usage used to live in settings as daily_usage_YYYY-MM-DD string values
+    cursor.execute("""CREATE TABLE IF NOT EXISTS daily_usage (
+        day TEXT PRIMARY KEY,
+        count INTEGER NOT NULL DEFAULT 0
+    )""")
+    cursor.execute("""INSERT OR REPLACE INTO daily_usage (day, count)
+                      SELECT substr(key, length('daily_usage_') + 1), CAST(value AS INTEGER)
+                      FROM settings WHERE key LIKE 'daily_usage_%'""")
+    cursor.execute("DELETE FROM settings WHERE key LIKE 'daily_usage_%'")
+
+
+def _add_summary_checkpoints(cursor):
+    # chat_context was never written to; it now holds rolling /tldr summaries,
+    # one row per (chat, thread, window length)
+    cursor.execute("DELETE FROM chat_context")
+    cursor.execute("ALTER TABLE chat_context ADD COLUMN window_minutes INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE chat_context ADD COLUMN window_start INTEGER")
+    cursor.execute("ALTER TABLE chat_context ADD COLUMN covered_until INTEGER")
+    cursor.execute("ALTER TABLE chat_context ADD COLUMN summary TEXT")
+    cursor.execute("ALTER TABLE chat_context ADD COLUMN mood TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_context_thread_window "
+                   "ON chat_context (chat_id, thread_id, window_minutes)")
+
+
+def _add_memory_content_hash(cursor):
+    # Personal memories were deduplicated with a leading-wildcard LIKE; a hash column
+    # with a unique index lets inserts use INSERT OR IGNORE instead
+    conn = cursor.connection
+    conn.create_function("content_hash", 1, content_hash, deterministic=True)
+    cursor.execute("ALTER TABLE personal_memories ADD COLUMN content_hash TEXT")
+    cursor.execute("UPDATE personal_memories SET content_hash = content_hash(memory_content)")
+    cursor.execute("""DELETE FROM personal_memories WHERE id NOT IN (
+                          SELECT MIN(id) FROM personal_memories GROUP BY user_id, memory_type, content_hash)""")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_personal_memories_dedup "
+                   "ON personal_memories (user_id, memory_type, content_hash)")
+
+
+def _add_processed_updates_table(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS processed_updates (
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        seen_at INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, message_id)
+    ) WITHOUT ROWID""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_seen_at ON processed_updates (seen_at)")
+
+
+def _add_response_cache_table(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        response TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        last_used INTEGER NOT NULL
+    ) WITHOUT ROWID""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)")
+
+
+def _add_memory_fts(cursor):
+    # External-content FTS5 index over memory.message, kept in step by triggers so
+    # batched inserts and retention deletes need no extra code
+    try:
+        cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(
+            message, content='memory', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )""")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"SQLite has no FTS5 ({e}), /search will be unavailable")
+        return
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS memory_fts_insert AFTER INSERT ON memory BEGIN
+        INSERT INTO memory_fts (rowid, message) VALUES (new.id, new.message);
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS memory_fts_delete AFTER DELETE ON memory BEGIN
+        INSERT INTO memory_fts (memory_fts, rowid, message) VALUES ('delete', old.id, old.message);
+    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS memory_fts_update AFTER UPDATE OF message ON memory BEGIN
+        INSERT INTO memory_fts (memory_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO memory_fts (rowid, message) VALUES (new.id, new.message);
+    END""")
+    cursor.execute("INSERT INTO memory_fts (memory_fts) VALUES ('rebuild')")
+
+
+def _use_incremental_vacuum(cursor):
+    # Retention frees pages every pass; with INCREMENTAL they can be handed back to the
+    # OS a chunk at a time (PRAGMA incremental_vacuum) instead of needing a full VACUUM.
+    # The mode only applies to an existing database once it's been vacuumed.
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # Retention deletes expired replies by age
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created_at ON response_cache (created_at)")
+    return True
+
+
+# (version, description, step) - append only, never edit a migration that has shipped.
+# The applied version is tracked in PRAGMA user_version. A step returning True asks
+# for a VACUUM once all migrations are done.
+MIGRATIONS = [
+    (1, "create base tables", _create_base_tables),
+    (2, "add memory.thread_id", _add_memory_thread_id),
+    (3, "add lookup indexes", _add_lookup_indexes),
+    (4, "integer ids and epoch-millis timestamps", _use_integer_columns),
+    (5, "daily_usage table", _add_daily_usage_table),
+    (6, "rolling summary checkpoints in chat_context", _add_summary_checkpoints),
+    (7, "personal_memories content hash", _add_memory_content_hash),
+    (8, "processed_updates table", _add_processed_updates_table),
+    (9, "response_cache table", _add_response_cache_table),
+    (10, "full-text index on memory", _add_memory_fts),
+    (11, "incremental auto_vacuum", _use_incremental_vacuum),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn=None):
+    """Bring the schema up to SCHEMA_VERSION, one transaction per migration"""
+    conn = conn or get_connection()
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return False
+
+    needs_vacuum = False
+    for version, description, step in MIGRATIONS:
+        # IMMEDIATE takes the write lock up front, so two processes starting at once
+        # can't both apply the same migration
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            logger.info(f"Applying schema migration {version}: {description}")
+            needs_vacuum = step(conn.cursor()) or needs_vacuum
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    if needs_vacuum:
+        logger.info("Compacting database after migration")
+        conn.execute("VACUUM")
+    return True
+
+
+def close_all():
+    """Stop the storage threads and close every open connection"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.error(f"Error closing connection: {e}")
+        _connections.clear()
+    _local.conn = None
@@ -0,0 +1,96 @@
+"""Webhook entry point - a small aiohttp server feeding updates into the Application"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public https URL registered with Telegram (unset = don't register)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Checked against X-Telegram-Bot-Api-Secret-Token
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_web_app(application, secret_token=None, path=WEBHOOK_PATH):
+    """aiohttp app that queues each POSTed update and answers straight away"""
+
+    async def handle_update(request):
+        if secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+            logger.warning(f"Rejected webhook call from {request.remote}: bad secret token")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            # A 500 would have Telegram redeliver it forever
+            logger.warning(f"Dropping malformed update: {e}")
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+
+        # Handlers run on the Application's own loop, Telegram only needs the 200
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(request):
+        return web.Response(text="ok")
+
+    web_app = web.Application()
+    web_app.router.add_post(path, handle_update)
+    web_app.router.add_get("/healthz", handle_health)
+    return web_app
+
+
+async def serve(application, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, stop_event=None):
+    """Run the application behind the webhook server until SIGINT/SIGTERM (or stop_event)"""
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Not on the main thread / not supported on this platform
+
+    # Same lifecycle run_polling goes through, so post_init and post_shutdown still fire
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    runner = web.AppRunner(make_web_app(application, secret_token, path))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    try:
+        await site.start()
+        if url:
+            await application.bot.set_webhook(url=url, secret_token=secret_token,
+                                              allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Webhook server listening on {host}:{port}{path}")
+        await stop_event.wait()
+    finally:
+        logger.info("Stopping webhook server...")
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run(application, **kwargs):
+    """Blocking webhook counterpart of application.run_polling()"""
+    asyncio.run(serve(application, **kwargs))